@@ -0,0 +1,432 @@
+# ==============================================================================
+# SUNFLOWER LAND BOT - BENCHMARK CON APIS SIMULADAS
+# ==============================================================================
+"""
+Mide el rendimiento del bot sin tocar las APIs reales.
+
+Levanta en otro proceso un servidor HTTP local que imita la API de Sunflower
+Land (/community/farms/<id>) y la Bot API de Telegram (sendMessage), carga
+sfl_bot_multi_4_advcrops-c.py apuntando a él y ejecuta, por los mismos
+caminos que usa el bot en producción:
+
+1. Barridos: N granjas sintéticas vencidas en FARM_SCHEDULER y procesadas
+   con run_due_farms. Reporta granjas/s, latencia de alertas (p50/p99, desde
+   el inicio del barrido hasta que el aviso llega a Telegram), CPU y memoria.
+2. Comandos: /crops de varios chats repartidos con route_update a las colas
+   de run_command_worker. Reporta la latencia p50/p99 desde que el update
+   se encola hasta la respuesta.
+3. Procesadores: build_farm_notification (todos los process_*) sobre
+   payloads de distintos tamaños, en ms por llamada.
+4. Tiempos (--timers, sin APIs simuladas): rutas NumPy y Python puro de
+   FarmTimerIndex (índice y consultas del monitor) según el tamaño de granja.
+
+Uso:
+    python sfl_benchmark.py --farms 200 --resources 500 --latency-ms 20 --rate-429 0.02
+    python sfl_benchmark.py --save baseline.json
+    python sfl_benchmark.py --baseline baseline.json   # compara con una ejecución previa
+    python sfl_benchmark.py --timers 1000 5000 10000
+"""
+
+import argparse
+import importlib.util
+import json
+import multiprocessing
+import os
+import queue
+import random
+import resource
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterable, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sfl_bot_multi_4_advcrops-c.py")
+
+CROP_NAMES = ["Sunflower", "Potato", "Pumpkin", "Carrot", "Cabbage", "Beetroot", "Cauliflower", "Parsnip",
+              "Eggplant", "Corn", "Radish", "Wheat", "Kale"]
+HOUR_MS = 3600 * 1000
+
+# ==============================================================================
+# 1. APIS SIMULADAS (proceso aparte)
+# ==============================================================================
+
+def make_synthetic_farm(resources: int, seed=0) -> Dict:
+    """Granja de prueba con `resources` recursos (60% cultivos, 20% árboles, 20% piedras),
+    una colmena y un evento de Floating Island."""
+    rng = random.Random(seed)
+    now_ms = time.time() * 1000
+    n_crops = resources * 3 // 5
+    n_trees = (resources - n_crops) // 2
+    return {"farm": {
+        "crops": {str(i): {"crop": {"name": rng.choice(CROP_NAMES), "plantedAt": int(now_ms - rng.uniform(0, 48 * HOUR_MS))}}
+                  for i in range(n_crops)},
+        "trees": {str(i): {"wood": {"choppedAt": int(now_ms - rng.uniform(0, 4 * HOUR_MS))}}
+                  for i in range(n_trees)},
+        "stones": {str(i): {"stone": {"minedAt": int(now_ms - rng.uniform(0, 8 * HOUR_MS))}}
+                   for i in range(resources - n_crops - n_trees)},
+        "beehives": {"1": {"swarm": False, "flowers": [{"attachedUntil": int(now_ms + rng.uniform(-HOUR_MS, HOUR_MS))}]}},
+        "floatingIsland": {"schedule": [{"startAt": int(now_ms + 2 * HOUR_MS), "endAt": int(now_ms + 3 * HOUR_MS)}]},
+    }}
+
+class MockState:
+    """Estado del servidor simulado (vive en el proceso del servidor)."""
+
+    def __init__(self, config: Dict):
+        self.config = config
+        self.rng = random.Random(config["seed"])
+        self.payloads: Dict[str, bytes] = {}
+        self.sent: List[List] = []   # [instante, chat_id]
+        self.farm_requests = 0
+        self.farm_429 = 0
+        self.lock = threading.Lock()
+
+class MockApiHandler(BaseHTTPRequestHandler):
+    """Imita las rutas de Sunflower Land y Telegram que usa el bot, más /_stats."""
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True   # Cabeceras y cuerpo van en escrituras separadas
+    state: MockState = None
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def _reply(self, code: int, body: bytes, headers: Optional[Dict[str, str]] = None) -> None:
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _reply_json(self, code: int, obj, headers: Optional[Dict[str, str]] = None) -> None:
+        self._reply(code, json.dumps(obj).encode(), headers)
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        state = self.state
+        config = state.config
+        if url.path.startswith("/community/farms/"):
+            farm_id = url.path.rsplit("/", 1)[-1]
+            if config["latency_ms"]:
+                time.sleep(config["latency_ms"] / 1000)
+            with state.lock:
+                state.farm_requests += 1
+                throttled = state.rng.random() < config["rate_429"]
+                if throttled:
+                    state.farm_429 += 1
+                payload = state.payloads.get(farm_id)
+                if payload is None:
+                    farm = make_synthetic_farm(config["resources"], f"{config['seed']}-{farm_id}")
+                    payload = state.payloads[farm_id] = json.dumps(farm).encode()
+            if throttled:
+                return self._reply_json(429, {"error": "Too Many Requests"}, {"Retry-After": str(config["retry_after"])})
+            return self._reply(200, payload)
+        if url.path == "/_stats":
+            since = int(parse_qs(url.query).get("since", ["0"])[0])
+            with state.lock:
+                return self._reply_json(200, {"sent": state.sent[since:], "farm_requests": state.farm_requests,
+                                              "farm_429": state.farm_429})
+        self._reply_json(404, {"ok": False})
+
+    def do_POST(self) -> None:
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+        state = self.state
+        if self.path.endswith("/sendMessage"):
+            chat_id = parse_qs(body).get("chat_id", [""])[0]
+            with state.lock:
+                state.sent.append([time.time(), chat_id])
+            return self._reply_json(200, {"ok": True, "result": {}})
+        self._reply_json(404, {"ok": False})
+
+def serve_mock_apis(config: Dict, port_queue: "multiprocessing.Queue") -> None:
+    """Punto de entrada del proceso del servidor simulado."""
+    MockApiHandler.state = MockState(config)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockApiHandler)
+    server.daemon_threads = True
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+# ==============================================================================
+# 2. MEDICIONES
+# ==============================================================================
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def peak_rss_mb() -> float:
+    # ru_maxrss viene en KB en Linux y en bytes en macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def import_bot(env: Dict[str, str]):
+    """Importa una copia nueva del script del bot con estas variables de entorno."""
+    os.environ.update(env)
+    spec = importlib.util.spec_from_file_location("sfl_bot", BOT_SCRIPT)
+    bot = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bot)
+    return bot
+
+def load_bot(base_url: str, args: argparse.Namespace):
+    """Importa el script del bot configurado contra las APIs simuladas."""
+    return import_bot({
+        "SFL_API_BASE_URL": base_url,
+        "TELEGRAM_API_BASE_URL": base_url,
+        "SFL_API_REQUESTS_PER_MINUTE": str(args.api_per_minute),
+        "SFL_API_BURST": str(args.fetch_workers),
+        "FARM_FETCH_WORKERS": str(args.fetch_workers),
+        "FARM_CACHE_TTL_SECONDS": "0",        # Cada barrido descarga de nuevo
+        "FARM_CACHE_STALE_SECONDS": "0",
+        "TELEGRAM_MESSAGES_PER_SECOND": str(args.telegram_per_second),
+        "TELEGRAM_PER_CHAT_INTERVAL_SECONDS": "0",
+        "LOG_LEVEL": os.getenv("LOG_LEVEL", "CRITICAL"),
+    })
+
+class MockClient:
+    """Acceso a los endpoints de control del servidor simulado."""
+
+    def __init__(self, bot, base_url: str):
+        self.session = bot.requests.Session()
+        self.base_url = base_url
+
+    def stats(self, since: int = 0) -> Dict:
+        return self.session.get(f"{self.base_url}/_stats", params={"since": since}, timeout=10).json()
+
+def bench_sweeps(bot, mock: MockClient, args: argparse.Namespace) -> Dict:
+    """Barridos con run_due_farms y todas las granjas vencidas a la vez.
+
+    Antes de cada barrido se limpia el estado de avisos, para que cada chat
+    reciba su alerta, y el intervalo de refresco de cada granja se pone a 0
+    para que se descargue de nuevo en lugar de servirse desde la caché.
+    """
+    user_data = {str(100000 + chat): {"farm_id": str(1 + chat // args.subscribers), "last_notified_status": {}}
+                 for chat in range(args.farms * args.subscribers)}
+    farm_ids = sorted({info["farm_id"] for info in user_data.values()})
+    farms_per_second = []
+    alert_latencies: List[float] = []
+    cpu_start, wall_start = cpu_seconds(), time.time()
+
+    for _ in range(args.sweeps):
+        for info in user_data.values():
+            info["last_notified_status"] = {}
+        sent_before = len(mock.stats()["sent"])
+        sweep_start = time.time()
+        for farm_id in farm_ids:
+            bot.FARM_SCHEDULER.set_refresh_interval(farm_id, 0)
+            bot.FARM_SCHEDULER.schedule(farm_id, sweep_start)
+        processed = bot.run_due_farms(user_data)
+        farms_per_second.append(processed / (time.time() - sweep_start))
+        bot.TELEGRAM_OUTBOX.drain(timeout=120)
+        alert_latencies.extend(sent_at - sweep_start for sent_at, _ in mock.stats(sent_before)["sent"])
+
+    cpu_used, wall = cpu_seconds() - cpu_start, time.time() - wall_start
+    stats = mock.stats()
+    return {
+        "farms_per_second": sum(farms_per_second) / len(farms_per_second),
+        "alerts": len(alert_latencies),
+        "alert_p50_ms": (percentile(alert_latencies, 0.50) or 0) * 1000,
+        "alert_p99_ms": (percentile(alert_latencies, 0.99) or 0) * 1000,
+        "cpu_seconds": cpu_used,
+        "cpu_percent": 100 * cpu_used / wall if wall else 0,
+        "farm_requests": stats["farm_requests"],
+        "farm_429": stats["farm_429"],
+    }
+
+def bench_commands(bot, mock: MockClient, args: argparse.Namespace) -> Dict:
+    """Un /crops por chat (cada uno de una granja distinta) encolado con route_update.
+
+    Los atienden COMMAND_WORKERS hilos con run_command_worker, igual que en
+    main_loop.
+    """
+    chats = [str(200000 + i) for i in range(args.commands)]
+    user_data = {chat: {"farm_id": str(1 + i % args.farms), "last_notified_status": {}} for i, chat in enumerate(chats)}
+    command_queues = [queue.Queue() for _ in range(max(1, bot.COMMAND_WORKERS))]
+    stop_event = threading.Event()
+    workers = [threading.Thread(target=bot.run_command_worker, args=(command_queue, user_data, stop_event), daemon=True)
+               for command_queue in command_queues]
+    for worker in workers:
+        worker.start()
+
+    sent_before = len(mock.stats()["sent"])
+    queued_at = {}
+    cpu_start, wall_start = cpu_seconds(), time.time()
+    for update_id, chat in enumerate(chats, start=1):
+        queued_at[chat] = time.time()
+        bot.route_update({"update_id": update_id,
+                          "message": {"chat": {"id": int(chat)}, "text": "/crops", "date": int(time.time())}},
+                         command_queues)
+    for command_queue in command_queues:
+        command_queue.join()
+    bot.TELEGRAM_OUTBOX.drain(timeout=120)
+    stop_event.set()
+
+    replied_at: Dict[str, float] = {}
+    for sent_at, chat in mock.stats(sent_before)["sent"]:
+        replied_at.setdefault(chat, sent_at)
+    cpu_used, wall = cpu_seconds() - cpu_start, time.time() - wall_start
+    latencies = [replied_at[chat] - queued_at[chat] for chat in replied_at]
+    return {
+        "commands": len(chats),
+        "answered": len(replied_at),
+        "command_p50_ms": (percentile(latencies, 0.50) or 0) * 1000,
+        "command_p99_ms": (percentile(latencies, 0.99) or 0) * 1000,
+        "cpu_seconds": cpu_used,
+        "cpu_percent": 100 * cpu_used / wall if wall else 0,
+    }
+
+def bench_processors(bot, args: argparse.Namespace) -> Dict:
+    """ms por llamada de build_farm_notification (índice + todos los process_*) según el tamaño."""
+    results = {}
+    for size in args.processor_sizes:
+        raw = json.dumps(make_synthetic_farm(size, seed=size))
+        repeat = max(3, 20000 // max(size, 1))
+        started = time.perf_counter()
+        for _ in range(repeat):
+            user_info = {"farm_id": "1", "last_notified_status": {}}
+            bot.build_farm_notification(user_info, json.loads(raw), time.time() * 1000)
+        results[str(size)] = (time.perf_counter() - started) / repeat * 1000
+    return results
+
+def run_timer_benchmark(sizes: Iterable[int], repeat: int = 20) -> None:
+    """Compara la ruta NumPy y la de Python puro de FarmTimerIndex sobre granjas sintéticas.
+
+    Cada ruta usa su propia copia del bot: una con la vectorización apagada y
+    otra con el TIMER_VECTORIZE_MIN_RESOURCES configurado (64 por defecto),
+    así que por debajo de ese tamaño ambas columnas miden lo mismo. Mide, en
+    ms, lo que hace el monitor con cada snapshot: por granja, construir el
+    índice y buscar el próximo vencimiento (`next_ready`); por chat
+    suscrito, contar lo que pasó a listo desde su último aviso
+    (`ready_between`). Comprueba que ambas rutas den exactamente lo mismo.
+    """
+    env = {"LOG_LEVEL": os.getenv("LOG_LEVEL", "CRITICAL")}
+    threshold = os.getenv("TIMER_VECTORIZE_MIN_RESOURCES", "64")
+    py_bot = import_bot({**env, "TIMER_VECTORIZE_MIN_RESOURCES": str(sys.maxsize)})
+    np_bot = import_bot({**env, "TIMER_VECTORIZE_MIN_RESOURCES": threshold})
+    if np_bot.numpy is None:
+        print("NumPy no está instalado: solo se mide la ruta en Python puro.")
+        np_bot = None
+
+    def measure(bot, farm: Dict, now_ms: float) -> Tuple[float, float, Tuple]:
+        started = time.perf_counter()
+        for _ in range(repeat):
+            index = bot.build_farm_index(farm["farm"])
+            tables = (index.crops, index.trees, index.stones)
+            next_due = [t.next_ready(now_ms) for t in tables]
+        farm_ms = (time.perf_counter() - started) / repeat * 1000
+        last_notified_ms = now_ms - HOUR_MS
+        started = time.perf_counter()
+        for _ in range(repeat):
+            newly_ready = [t.ready_between(last_notified_ms, now_ms) for t in tables]
+        chat_ms = (time.perf_counter() - started) / repeat * 1000
+        return farm_ms, chat_ms, (index.crops.ready_at, next_due, newly_ready)
+
+    print(f"TIMER_VECTORIZE_MIN_RESOURCES={threshold}")
+    print(f"{'recursos':>9} | {'granja py':>9} {'granja np':>9} {'speedup':>8} | "
+          f"{'chat py':>8} {'chat np':>8} {'speedup':>8}")
+    for size in sizes:
+        farm = make_synthetic_farm(size)
+        now_ms = time.time() * 1000
+        py_farm, py_chat, py_result = measure(py_bot, farm, now_ms)
+        if np_bot is None:
+            print(f"{size:>9} | {py_farm:>9.3f} {'-':>9} {'-':>8} | {py_chat:>8.3f} {'-':>8} {'-':>8}")
+            continue
+        np_farm, np_chat, np_result = measure(np_bot, farm, now_ms)
+        if np_result != py_result:
+            raise AssertionError(f"Las rutas NumPy y Python difieren con {size} recursos")
+        print(f"{size:>9} | {py_farm:>9.3f} {np_farm:>9.3f} {py_farm / np_farm:>7.2f}x | "
+              f"{py_chat:>8.3f} {np_chat:>8.3f} {py_chat / np_chat:>7.2f}x")
+
+# ==============================================================================
+# 3. REPORTE Y COMPARACIÓN CON BASELINE
+# ==============================================================================
+
+def print_report(results: Dict, baseline: Optional[Dict]) -> None:
+    def line(section: str, key: str, label: str, unit: str = "") -> None:
+        value = results[section][key]
+        text = f"  {label:<28} {value:>10.2f} {unit}"
+        previous = (baseline or {}).get(section, {}).get(key)
+        if previous:
+            text += f"   (baseline {previous:.2f}, {100 * (value - previous) / previous:+.1f}%)"
+        print(text)
+
+    config = results["config"]
+    print(f"Barridos: {config['farms']} granjas × {config['subscribers']} chats, {config['resources']} recursos, "
+          f"latencia {config['latency_ms']} ms, 429 {config['rate_429']:.0%}")
+    line("sweeps", "farms_per_second", "granjas/s")
+    line("sweeps", "alert_p50_ms", "alerta p50", "ms")
+    line("sweeps", "alert_p99_ms", "alerta p99", "ms")
+    line("sweeps", "cpu_percent", "CPU", "%")
+    print(f"  {'avisos / peticiones / 429':<28} {results['sweeps']['alerts']} / "
+          f"{results['sweeps']['farm_requests']} / {results['sweeps']['farm_429']}")
+    print(f"Comandos: {results['commands']['answered']}/{results['commands']['commands']} respondidos")
+    line("commands", "command_p50_ms", "comando p50", "ms")
+    line("commands", "command_p99_ms", "comando p99", "ms")
+    print("Procesadores (build_farm_notification):")
+    for size in results["processors"]:
+        line("processors", size, f"{size} recursos", "ms")
+    line("memory", "peak_rss_mb", "memoria pico (RSS)", "MB")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark del bot contra APIs simuladas")
+    parser.add_argument("--farms", type=int, default=100, help="granjas distintas")
+    parser.add_argument("--subscribers", type=int, default=1, help="chats por granja")
+    parser.add_argument("--resources", type=int, default=200, help="recursos por granja")
+    parser.add_argument("--sweeps", type=int, default=3, help="barridos a medir")
+    parser.add_argument("--commands", type=int, default=50, help="comandos /crops a medir")
+    parser.add_argument("--latency-ms", type=float, default=0, help="latencia añadida por la API simulada")
+    parser.add_argument("--rate-429", type=float, default=0, help="fracción de respuestas 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After de los 429")
+    parser.add_argument("--fetch-workers", type=int, default=4, help="FARM_FETCH_WORKERS")
+    parser.add_argument("--api-per-minute", type=float, default=60000, help="SFL_API_REQUESTS_PER_MINUTE")
+    parser.add_argument("--telegram-per-second", type=float, default=1000, help="TELEGRAM_MESSAGES_PER_SECOND")
+    parser.add_argument("--processor-sizes", type=int, nargs="*", default=[100, 1000, 5000])
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", help="guarda los resultados en este JSON")
+    parser.add_argument("--baseline", help="JSON de una ejecución previa para comparar")
+    parser.add_argument("--timers", type=int, nargs="*", metavar="RECURSOS",
+                        help="solo compara las rutas NumPy/Python de FarmTimerIndex con estos tamaños")
+    args = parser.parse_args()
+
+    if args.timers is not None:
+        run_timer_benchmark(args.timers or (32, 64, 200, 1000, 5000, 10000))
+        return
+
+    config = {"resources": args.resources, "latency_ms": args.latency_ms, "rate_429": args.rate_429,
+              "retry_after": args.retry_after, "seed": args.seed}
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve_mock_apis, args=(config, port_queue), daemon=True)
+    server.start()
+    base_url = f"http://127.0.0.1:{port_queue.get(timeout=10)}"
+
+    try:
+        bot = load_bot(base_url, args)
+        mock = MockClient(bot, base_url)
+        results = {
+            "config": {"farms": args.farms, "subscribers": args.subscribers, **config},
+            "sweeps": bench_sweeps(bot, mock, args),
+            "commands": bench_commands(bot, mock, args),
+            "processors": bench_processors(bot, args),
+            "memory": {"peak_rss_mb": peak_rss_mb()},
+        }
+    finally:
+        server.terminate()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -27,13 +27,45 @@ Características principales:
 # ------------------------------------------------------------------------------
 # 1.1 Importación de módulos
 # ------------------------------------------------------------------------------
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from typing import Dict, List, Tuple, Optional
+from email.utils import parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, Iterator, List, Set, Tuple, Optional
+import bisect
+import cProfile
+import hashlib
+import heapq
+import hmac
+import io
+import itertools
 import json
 import logging
 import os
+import pstats
+import queue
+import random
+import signal
+import socket
+import sqlite3
+import sys
 import requests
+import threading
 import time
+import tracemalloc
+import uuid
+from requests.adapters import HTTPAdapter
+
+try:
+    import numpy   # Opcional: acelera los tiempos de granjas grandes (pip install numpy)
+except ImportError:
+    numpy = None
+
+try:
+    import orjson  # Opcional: decodifica el JSON de las granjas más rápido (pip install orjson)
+except ImportError:
+    orjson = None
 
 # ------------------------------------------------------------------------------
 # 1.2 Configuración de claves y tokens
@@ -46,7 +78,12 @@ TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "8520207393:AAEfnm0T0cXoavK
 # ------------------------------------------------------------------------------
 # Frecuencias de chequeo
 LOOP_SLEEP_SECONDS = 5                 # Intervalo entre chequeos de comandos
-FARM_CHECK_INTERVAL_SECONDS = 300      # Intervalo entre chequeos de granja (5 min)
+TELEGRAM_POLL_BACKOFF_MAX_SECONDS = 60  # Espera máxima entre reintentos si getUpdates falla
+COMMAND_WORKERS = int(os.getenv("COMMAND_WORKERS", "4"))  # Hilos que atienden comandos
+COMMAND_QUEUE_MAXSIZE = 1000           # Updates pendientes por worker antes de bloquear la recepción
+FARM_CHECK_INTERVAL_SECONDS = 300      # Refresco de granjas con temporizadores pendientes (5 min)
+FARM_IDLE_REFRESH_SECONDS = int(os.getenv("FARM_IDLE_REFRESH_SECONDS", "1800"))  # Refresco de granjas sin nada pendiente (30 min)
+SCHEDULER_SLACK_SECONDS = 1            # Margen tras un deadline antes de procesarlo
 
 # Tiempos base de recursos (en milisegundos)
 LOVE_INTERVAL_MS = 8 * 60 * 60 * 1000  # Intervalo de amor para animales (8h)
@@ -57,14 +94,114 @@ STONE_RESPAWN_BASE_MS = 4 * 60 * 60 * 1000  # Reaparición de piedras (4h)
 # Tiempos de Floating Island
 PRE_EVENT_ALERT_MS = 5 * 60 * 1000      # Alerta 5 minutos antes del evento
 
+# Presupuesto de la API de Sunflower Land (compartido por comandos y monitoreo)
+SFL_API_REQUESTS_PER_MINUTE = float(os.getenv("SFL_API_REQUESTS_PER_MINUTE", "30"))  # Cuota sostenida
+SFL_API_BURST = int(os.getenv("SFL_API_BURST", "3"))                  # Peticiones seguidas permitidas
+FARM_FETCH_WORKERS = int(os.getenv("FARM_FETCH_WORKERS", "4"))        # Hilos de descarga por chequeo
+SFL_API_COMMAND_RESERVE = 1            # Tokens que el monitor deja libres para los comandos
+
+# Reintentos y cortacircuitos ante fallos de la API
+SFL_API_MAX_RETRIES = int(os.getenv("SFL_API_MAX_RETRIES", "3"))      # Reintentos del monitor (los comandos: 1)
+SFL_API_BACKOFF_BASE_SECONDS = 2       # Primer backoff; se duplica en cada intento (con jitter)
+SFL_API_BACKOFF_MAX_SECONDS = 120      # Tope de espera entre reintentos
+COMMAND_MAX_RETRY_WAIT_SECONDS = 5     # Un comando no espera más que esto para reintentar
+SFL_API_MIN_RATE_FRACTION = 0.1        # Ante 429 la cuota baja a la mitad, hasta este mínimo
+FARM_BREAKER_FAILURE_THRESHOLD = 3     # Fallos seguidos antes de aparcar una granja
+FARM_BREAKER_COOLDOWN_SECONDS = 600    # Primer aparcamiento (se duplica si sigue fallando)
+FARM_BREAKER_MAX_COOLDOWN_SECONDS = 6 * 3600
+
+# Límite de comandos que consultan la API, por chat y por granja
+COMMAND_CHAT_PER_MINUTE = float(os.getenv("COMMAND_CHAT_PER_MINUTE", "6"))   # Consultas sostenidas por chat
+COMMAND_CHAT_BURST = int(os.getenv("COMMAND_CHAT_BURST", "3"))               # Consultas seguidas por chat
+COMMAND_FARM_PER_MINUTE = float(os.getenv("COMMAND_FARM_PER_MINUTE", "4"))   # Consultas sostenidas por granja
+COMMAND_FARM_BURST = int(os.getenv("COMMAND_FARM_BURST", "3"))               # Consultas seguidas por granja
+
+# Caché de snapshots de granja (compartida por comandos y monitoreo)
+FARM_CACHE_TTL_SECONDS = float(os.getenv("FARM_CACHE_TTL_SECONDS", "60"))      # Datos considerados frescos
+FARM_CACHE_STALE_SECONDS = float(os.getenv("FARM_CACHE_STALE_SECONDS", "240")) # Ventana extra sirviendo datos viejos mientras se refresca
+FARM_CACHE_MAX_ENTRIES = int(os.getenv("FARM_CACHE_MAX_ENTRIES", "1000"))      # Máximo de granjas en caché
+FARM_CACHE_MAX_BYTES = int(os.getenv("FARM_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))  # Límite de memoria aprox. (64MB)
+
+# Modo clúster (procesos `coordinator` + N `worker` compartiendo STATE_DB_FILE)
+CLUSTER_ROLE = os.getenv("CLUSTER_ROLE", "single")   # "single", "coordinator" o "worker"
+CLUSTER_MEMBER_ID = os.getenv("CLUSTER_MEMBER_ID") or os.getenv("DYNO") or f"{socket.gethostname()}-{os.getpid()}"
+CLUSTER_HEARTBEAT_SECONDS = float(os.getenv("CLUSTER_HEARTBEAT_SECONDS", "2"))     # Latido de cada proceso
+CLUSTER_MEMBER_TTL_SECONDS = float(os.getenv("CLUSTER_MEMBER_TTL_SECONDS", "8"))   # Sin latido: se da por caído
+CLUSTER_STATE_REFRESH_SECONDS = float(os.getenv("CLUSTER_STATE_REFRESH_SECONDS", "15"))  # Relectura de suscripciones
+CLUSTER_VIRTUAL_NODES = 64             # Puntos por worker en el anillo de hash consistente
+
+# Lease de instancia única: solo quien lo tiene recibe updates y escribe el estado
+INSTANCE_LEASE_ENABLED = os.getenv("INSTANCE_LEASE_ENABLED", "1") == "1"
+INSTANCE_LEASE_TTL_SECONDS = float(os.getenv("INSTANCE_LEASE_TTL_SECONDS", "10"))     # Sin renovar: el lease queda libre
+INSTANCE_LEASE_RENEW_SECONDS = float(os.getenv("INSTANCE_LEASE_RENEW_SECONDS", "2"))  # Renovación y sondeo del standby
+# Titular del lease, único por proceso: en un deploy la copia vieja y la nueva comparten DYNO
+INSTANCE_HOLDER_ID = f"{CLUSTER_MEMBER_ID}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+# Con NumPy instalado, las tablas de al menos este tamaño se calculan en bloque
+TIMER_VECTORIZE_MIN_RESOURCES = int(os.getenv("TIMER_VECTORIZE_MIN_RESOURCES", "64"))
+
 # ------------------------------------------------------------------------------
-# 1.4 Configuración de archivos y logging
+# 1.4 Clientes HTTP
+# ------------------------------------------------------------------------------
+SFL_API_BASE_URL = os.getenv("SFL_API_BASE_URL", "https://api.sunflower-land.com")
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL", "https://api.telegram.org")
+
+# Conexiones keep-alive reutilizables por host
+SFL_HTTP_POOL_SIZE = int(os.getenv("SFL_HTTP_POOL_SIZE", str(FARM_FETCH_WORKERS * 2)))
+TELEGRAM_HTTP_POOL_SIZE = int(os.getenv("TELEGRAM_HTTP_POOL_SIZE", "4"))
+
+# Timeouts (segundos): conexión corta, lectura según el servicio
+HTTP_CONNECT_TIMEOUT_SECONDS = float(os.getenv("HTTP_CONNECT_TIMEOUT_SECONDS", "3.05"))
+SFL_READ_TIMEOUT_SECONDS = float(os.getenv("SFL_READ_TIMEOUT_SECONDS", "10"))
+TELEGRAM_READ_TIMEOUT_SECONDS = float(os.getenv("TELEGRAM_READ_TIMEOUT_SECONDS", "10"))
+
+# Recepción de updates: "polling" (getUpdates) o "webhook" (servidor HTTP propio)
+TELEGRAM_INTAKE_MODE = os.getenv("TELEGRAM_INTAKE_MODE", "polling")
+WEBHOOK_LISTEN_HOST = os.getenv("WEBHOOK_LISTEN_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", "8080"))   # El proceso web de Heroku recibe PORT
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_PUBLIC_URL = os.getenv("WEBHOOK_PUBLIC_URL", "")     # Si se define, se registra con setWebhook
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN", "")  # Cabecera X-Telegram-Bot-Api-Secret-Token (obligatoria en modo webhook)
+
+# Métricas Prometheus y chequeos de salud (GET /metrics, /healthz y /readyz en PORT, o en METRICS_PORT en los workers)
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+# Puerto HTTP de los procesos que no reciben updates (workers del clúster); 0: uno libre (se anota en el log)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+HEALTH_MAX_SWEEP_LAG_SECONDS = float(os.getenv("HEALTH_MAX_SWEEP_LAG_SECONDS", str(FARM_CHECK_INTERVAL_SECONDS)))  # Retraso tolerado del monitor
+
+# Comandos: en grupos, `/crops@OtroBot` se ignora si se define el nombre del bot
+TELEGRAM_BOT_USERNAME = os.getenv("TELEGRAM_BOT_USERNAME", "").lstrip("@").lower()
+TELEGRAM_ADMIN_CHAT_IDS = {c.strip() for c in os.getenv("TELEGRAM_ADMIN_CHAT_IDS", "").split(",") if c.strip()}
+
+# Cola de salida de Telegram (límites de la Bot API)
+TELEGRAM_MESSAGES_PER_SECOND = float(os.getenv("TELEGRAM_MESSAGES_PER_SECOND", "30"))  # Límite global
+TELEGRAM_PER_CHAT_INTERVAL_SECONDS = float(os.getenv("TELEGRAM_PER_CHAT_INTERVAL_SECONDS", "1"))  # ~1 msg/s por chat
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096     # Máximo de caracteres al combinar avisos de un mismo chat
+TELEGRAM_SEND_MAX_RETRIES = 5          # Reintentos de un mensaje antes de descartarlo
+
+# Persistencia del estado: cambios acumulados antes de escribir a disco
+STATE_FLUSH_DEBOUNCE_SECONDS = float(os.getenv("STATE_FLUSH_DEBOUNCE_SECONDS", "10"))
+STATE_BACKEND = os.getenv("STATE_BACKEND", "json")   # "json" (sfl_users.json) o "sqlite"
+
+# ------------------------------------------------------------------------------
+# 1.5 Configuración de archivos y logging
 # ------------------------------------------------------------------------------
 # Usar rutas absolutas basadas en la ubicación del script para que el código
 # funcione aunque el working directory cambie o el proyecto se mueva.
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 USER_DATA_FILE = os.path.join(BASE_DIR, "sfl_users.json")
+STATE_DB_FILE = os.getenv("STATE_DB_FILE", os.path.join(BASE_DIR, "sfl_state.db"))
+INSTANCE_LEASE_FILE = os.getenv("INSTANCE_LEASE_FILE", STATE_DB_FILE)   # Base SQLite donde vive el lease
 LOG_FILE = os.path.join(BASE_DIR, "sfl_bot.log")
+PAYLOAD_LOG_FILE = os.path.join(BASE_DIR, "sfl_payloads.log")
+PROFILE_DIR = os.getenv("PROFILE_DIR", BASE_DIR)   # Perfiles capturados con /profile o SIGUSR1/SIGUSR2
+PROFILE_DEFAULT_SWEEPS = int(os.getenv("PROFILE_DEFAULT_SWEEPS", "3"))  # Barridos por captura si no se indica
+PROFILE_MAX_SWEEPS = 20                # Máximo de barridos en una captura
+
+# Nivel del logger (los mensajes por debajo no se formatean) y captura de
+# respuestas crudas de la API: fracción de respuestas a guardar (0 = apagado)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "WARNING").upper()
+PAYLOAD_CAPTURE_RATE = float(os.getenv("PAYLOAD_CAPTURE_RATE", "0"))
 
 # VARIABLE GLOBAL PARA LAST_UPDATE_ID
 LAST_UPDATE_ID = None
@@ -73,7 +210,7 @@ LAST_UPDATE_ID = None
 
 # Rotating log file: 2MB per file, keep 3 backups, WARNING and above only
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.WARNING)
+logger.setLevel(getattr(logging, LOG_LEVEL, logging.WARNING))
 formatter = logging.Formatter('[%(asctime)s] %(levelname)s: %(message)s', datefmt='%H:%M:%S')
 
 file_handler = RotatingFileHandler(LOG_FILE, maxBytes=2*1024*1024, backupCount=3, encoding='utf-8')
@@ -82,10 +219,34 @@ file_handler.setLevel(logging.WARNING)
 
 stream_handler = logging.StreamHandler()
 stream_handler.setFormatter(formatter)
-stream_handler.setLevel(logging.INFO)
+stream_handler.setLevel(logging.DEBUG if LOG_LEVEL == "DEBUG" else logging.INFO)
 
 logger.handlers = [file_handler, stream_handler]
 
+# Captura muestreada de payloads: archivo rotativo aparte, solo si se activa
+payload_logger = logging.getLogger(f"{__name__}.payloads")
+payload_logger.propagate = False
+payload_logger.setLevel(logging.INFO)
+if PAYLOAD_CAPTURE_RATE > 0:
+    payload_handler = RotatingFileHandler(PAYLOAD_LOG_FILE, maxBytes=10*1024*1024, backupCount=2, encoding='utf-8')
+    payload_handler.setFormatter(logging.Formatter('[%(asctime)s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+    payload_logger.handlers = [payload_handler]
+
+def log_event(level: int, event: str, **fields) -> None:
+    """Log estructurado 'evento clave=valor ...'.
+
+    Si el nivel está desactivado no se formatea nada: los argumentos no
+    deben ser caros de calcular (nada de json.dumps del payload).
+    """
+    if logger.isEnabledFor(level):
+        logger.log(level, "%s %s", event, " ".join(f"{key}={value}" for key, value in fields.items()))
+
+def capture_payload(source: str, key: str, raw: bytes) -> None:
+    """Guarda una respuesta cruda en PAYLOAD_LOG_FILE con probabilidad PAYLOAD_CAPTURE_RATE."""
+    if PAYLOAD_CAPTURE_RATE <= 0 or random.random() >= PAYLOAD_CAPTURE_RATE:
+        return
+    payload_logger.info("%s %s %d bytes %s", source, key, len(raw), raw.decode('utf-8', errors='replace'))
+
 # ==============================================================================
 # 2. DATOS DE JUEGO Y CONFIGURACIÓN
 # ==============================================================================
@@ -162,6 +323,147 @@ Esta sección contiene funciones auxiliares utilizadas en todo el bot:
 - Parsing y conversión de datos
 """
 
+def build_http_session(pool_size: int) -> requests.Session:
+    """Crea una sesión HTTP con un pool de conexiones keep-alive.
+
+    Reutilizar la sesión evita un handshake TCP + TLS nuevo en cada llamada.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+# Una sesión por host: api.sunflower-land.com y api.telegram.org
+SFL_SESSION = build_http_session(SFL_HTTP_POOL_SIZE)
+TELEGRAM_SESSION = build_http_session(TELEGRAM_HTTP_POOL_SIZE)
+
+def telegram_api_url(method: str) -> str:
+    """URL de un método de la Bot API de Telegram."""
+    return f"{TELEGRAM_API_BASE_URL}/bot{TELEGRAM_BOT_TOKEN}/{method}"
+
+# Límites (s) de las cubetas de los histogramas de latencia
+METRIC_BUCKETS_SECONDS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+# Muestra de un collector: (nombre, tipo, ayuda, etiquetas, valor)
+MetricSample = Tuple[str, str, str, Dict[str, str], float]
+
+class MetricsRegistry:
+    """Contadores e histogramas en memoria, servidos en formato texto de Prometheus.
+
+    Lo que ya cuentan otras clases (caché, outbox, estado, limitadores) no se
+    duplica aquí: los `collectors` lo leen en cada GET /metrics.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = METRIC_BUCKETS_SECONDS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._meta: Dict[str, Tuple[str, str]] = {}     # nombre -> (tipo, ayuda)
+        self._counters: Dict[Tuple[str, Tuple], float] = {}
+        self._histograms: Dict[Tuple[str, Tuple], List] = {}   # [cuentas por cubeta, suma, total]
+        self._collectors: List[Callable[[], Iterable[MetricSample]]] = []
+
+    def describe(self, name: str, kind: str, help_text: str) -> None:
+        self._meta[name] = (kind, help_text)
+
+    def add_collector(self, collector: Callable[[], Iterable[MetricSample]]) -> None:
+        self._collectors.append(collector)
+
+    def inc(self, name: str, value: float = 1.0, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            series = self._histograms.get(key)
+            if series is None:
+                series = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def totals(self, name: str) -> Dict[Tuple, Tuple[float, int]]:
+        """(suma, cantidad) de cada serie del histograma `name`, por etiquetas."""
+        with self._lock:
+            return {labels: (series[1], series[2]) for (metric, labels), series in self._histograms.items()
+                    if metric == name}
+
+    @staticmethod
+    def _sample(name: str, labels: Iterable[Tuple[str, str]], value: float) -> str:
+        pairs = ",".join('{}="{}"'.format(key, str(val).replace("\\", "\\\\").replace('"', '\\"'))
+                         for key, val in labels)
+        # Enteros tal cual; floats con repr, que no pierde dígitos (p. ej. timestamps)
+        if isinstance(value, int):
+            text = str(int(value))
+        elif value != value:
+            text = "NaN"
+        elif value in (float("inf"), float("-inf")):
+            text = "+Inf" if value > 0 else "-Inf"
+        else:
+            text = repr(float(value))
+        return f"{name}{{{pairs}}} {text}" if pairs else f"{name} {text}"
+
+    def render(self) -> str:
+        lines: Dict[str, List[str]] = {}
+        meta = dict(self._meta)
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                lines.setdefault(name, []).append(self._sample(name, labels, value))
+            for (name, labels), (counts, total, count) in self._histograms.items():
+                series = lines.setdefault(name, [])
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                    series.append(self._sample(f"{name}_bucket", labels + (("le", le),), cumulative))
+                series.append(self._sample(f"{name}_sum", labels, total))
+                series.append(self._sample(f"{name}_count", labels, count))
+        for collector in self._collectors:
+            try:
+                samples = list(collector())
+            except Exception as e:
+                logger.exception(f"🚨 Error leyendo métricas: {e}")
+                continue
+            for name, kind, help_text, labels, value in samples:
+                meta.setdefault(name, (kind, help_text))
+                lines.setdefault(name, []).append(self._sample(name, sorted(labels.items()), value))
+
+        output = []
+        for name, series in lines.items():
+            kind, help_text = meta.get(name, ("untyped", ""))
+            output.append(f"# HELP {name} {help_text}")
+            output.append(f"# TYPE {name} {kind}")
+            output.extend(series)
+        return "\n".join(output) + "\n"
+
+METRICS = MetricsRegistry()
+METRICS.describe("sfl_farm_fetch_duration_seconds", "histogram", "Duración de cada petición a la API de Sunflower Land")
+METRICS.describe("sfl_farm_fetch_responses_total", "counter", "Respuestas de la API de Sunflower Land por código HTTP")
+METRICS.describe("sfl_sweep_duration_seconds", "histogram", "Duración de cada pasada del monitor por las granjas vencidas")
+METRICS.describe("sfl_farm_due_lag_seconds", "histogram", "Retraso entre el deadline de una granja y su procesamiento")
+METRICS.describe("sfl_alerts_sent_total", "counter", "Avisos de granja entregados a la cola de Telegram")
+METRICS.describe("sfl_command_duration_seconds", "histogram", "Duración de cada comando de Telegram")
+METRICS.describe("sfl_command_errors_total", "counter", "Comandos que terminaron con excepción")
+METRICS.describe("sfl_sweep_phase_seconds", "histogram", "Duración de cada fase del procesamiento de granjas")
+
+class PhaseTimer:
+    """`with PhaseTimer("decode"):` suma la duración del bloque a sfl_sweep_phase_seconds."""
+
+    __slots__ = ("phase", "started")
+
+    def __init__(self, phase: str):
+        self.phase = phase
+
+    def __enter__(self) -> "PhaseTimer":
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> bool:
+        METRICS.observe("sfl_sweep_phase_seconds", time.perf_counter() - self.started, phase=self.phase)
+        return False
+
 def load_user_data() -> Dict:
     """Carga los datos de los usuarios desde el archivo JSON."""
     if not os.path.exists(USER_DATA_FILE):
@@ -173,29 +475,372 @@ def load_user_data() -> Dict:
         logger.warning(f"Archivo {USER_DATA_FILE} dañado o vacío. Reiniciando datos. Error: {e}")
         return {}
 
-def save_user_data(data: Dict) -> None:
-    """Guarda los datos de los usuarios en el archivo JSON."""
+def write_file_atomically(path: str, text: str) -> bool:
+    """Escribe `text` en un temporal y lo renombra encima de `path`.
+
+    Un corte a mitad de escritura nunca deja el archivo original dañado.
+    """
+    tmp_path = f"{path}.tmp"
     try:
-        with open(USER_DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
-    except IOError as e:
-        logger.error(f"No se pudo escribir en {USER_DATA_FILE}: {e}")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+        return True
+    except (IOError, OSError) as e:
+        logger.error(f"No se pudo escribir en {path}: {e}")
+        return False
+
+def diff_flags(before: Dict, after: Dict) -> Set[str]:
+    """Banderas de last_notified_status que cambiaron (incluye altas y bajas)."""
+    missing = object()
+    return {key for key in before.keys() | after.keys() if before.get(key, missing) != after.get(key, missing)}
+
+# Cambios pendientes: {clave: None (entrada completa) o {banderas modificadas}}
+DirtyMap = Dict[str, Optional[Set[str]]]
+
+class StateBackend:
+    """Interfaz de persistencia del estado de usuarios.
+
+    `collect_changes` se llama bajo el lock del estado y debe copiar lo que
+    necesite; `apply_changes` se llama fuera del lock y hace la escritura.
+    """
+
+    name = "base"
+
+    def load_all(self) -> Dict:
+        raise NotImplementedError
+
+    def collect_changes(self, data: Dict, dirty: DirtyMap):
+        raise NotImplementedError
+
+    def apply_changes(self, changes) -> bool:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+    def size_bytes(self) -> int:
+        """Tamaño en disco del estado (0 si no se puede medir)."""
+        return 0
+
+class JsonFileBackend(StateBackend):
+    """Backend original: todo el estado en sfl_users.json, reescrito completo."""
+
+    name = "json"
+
+    def load_all(self) -> Dict:
+        return load_user_data()
+
+    def collect_changes(self, data: Dict, dirty: DirtyMap) -> str:
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+    def apply_changes(self, changes: str) -> bool:
+        return write_file_atomically(USER_DATA_FILE, changes)
+
+    def size_bytes(self) -> int:
+        try:
+            return os.path.getsize(USER_DATA_FILE)
+        except OSError:
+            return 0
+
+class SqliteBackend(StateBackend):
+    """Backend SQLite (modo WAL) con tablas indexadas.
+
+    - subscriptions: un registro por chat (farm_id + campos extra en JSON)
+    - notification_flags: una fila por (chat_id, bandera)
+    - meta: claves globales que empiezan con '_' (p. ej. _last_update_id)
+
+    Cambiar una bandera de alerta es un UPSERT de una sola fila.
+    """
+
+    name = "sqlite"
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            chat_id TEXT PRIMARY KEY,
+            farm_id TEXT,
+            extra TEXT NOT NULL DEFAULT '{}'
+        );
+        CREATE INDEX IF NOT EXISTS idx_subscriptions_farm ON subscriptions(farm_id);
+        CREATE TABLE IF NOT EXISTS notification_flags (
+            chat_id TEXT NOT NULL,
+            flag TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (chat_id, flag)
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+        self._conn.commit()
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT (SELECT COUNT(*) FROM subscriptions) + (SELECT COUNT(*) FROM meta)"
+            ).fetchone()
+        return row[0] == 0
+
+    def load_all(self) -> Dict:
+        data: Dict = {}
+        with self._lock:
+            for key, value in self._conn.execute("SELECT key, value FROM meta"):
+                data[key] = json.loads(value)
+            for chat_id, farm_id, extra in self._conn.execute("SELECT chat_id, farm_id, extra FROM subscriptions"):
+                entry = json.loads(extra)
+                if farm_id is not None:
+                    entry['farm_id'] = farm_id
+                entry['last_notified_status'] = {}
+                data[chat_id] = entry
+            for chat_id, flag, value in self._conn.execute("SELECT chat_id, flag, value FROM notification_flags"):
+                if isinstance(data.get(chat_id), dict):
+                    data[chat_id]['last_notified_status'][flag] = json.loads(value)
+        return data
+
+    def collect_changes(self, data: Dict, dirty: DirtyMap) -> List[Tuple[str, tuple]]:
+        ops: List[Tuple[str, tuple]] = []
+        for key, flags in dirty.items():
+            entry = data.get(key)
+            if key.startswith('_'):
+                if key in data:
+                    ops.append(("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(entry))))
+                else:
+                    ops.append(("DELETE FROM meta WHERE key = ?", (key,)))
+                continue
+            if not isinstance(entry, dict):
+                ops.append(("DELETE FROM subscriptions WHERE chat_id = ?", (key,)))
+                ops.append(("DELETE FROM notification_flags WHERE chat_id = ?", (key,)))
+                continue
+            status = entry.get('last_notified_status', {})
+            if flags is None:
+                extra = {k: v for k, v in entry.items() if k not in ('farm_id', 'last_notified_status')}
+                ops.append(("INSERT OR REPLACE INTO subscriptions (chat_id, farm_id, extra) VALUES (?, ?, ?)",
+                            (key, entry.get('farm_id'), json.dumps(extra, ensure_ascii=False))))
+                ops.append(("DELETE FROM notification_flags WHERE chat_id = ?", (key,)))
+                flags = set(status.keys())
+            for flag in flags:
+                if flag in status:
+                    ops.append(("INSERT OR REPLACE INTO notification_flags (chat_id, flag, value) VALUES (?, ?, ?)",
+                                (key, flag, json.dumps(status[flag]))))
+                else:
+                    ops.append(("DELETE FROM notification_flags WHERE chat_id = ? AND flag = ?", (key, flag)))
+        return ops
+
+    def apply_changes(self, changes: List[Tuple[str, tuple]]) -> bool:
+        try:
+            with self._lock, self._conn:
+                for sql, params in changes:
+                    self._conn.execute(sql, params)
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"No se pudo escribir en {self.path}: {e}")
+            return False
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def size_bytes(self) -> int:
+        """Base más el WAL pendiente de checkpoint."""
+        return sum(os.path.getsize(path) for path in (self.path, f"{self.path}-wal") if os.path.exists(path))
+
+def migrate_json_to_sqlite(json_path: str, backend: SqliteBackend) -> int:
+    """Migra de una vez el formato de sfl_users.json al backend SQLite.
+
+    Retorna cuántas entradas se migraron.
+    """
+    try:
+        with open(json_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (json.JSONDecodeError, IOError) as e:
+        logger.warning(f"No se pudo leer {json_path} para migrar: {e}")
+        return 0
+    if not backend.apply_changes(backend.collect_changes(data, {key: None for key in data})):
+        return 0
+    return len(data)
+
+def create_state_backend(kind: str = STATE_BACKEND) -> StateBackend:
+    """Crea el backend indicado (por defecto STATE_BACKEND).
+
+    Con "sqlite", si la base está vacía y existe sfl_users.json, se migra
+    automáticamente la primera vez.
+    """
+    if kind == "sqlite":
+        backend = SqliteBackend(STATE_DB_FILE)
+        if backend.is_empty() and os.path.exists(USER_DATA_FILE):
+            migrated = migrate_json_to_sqlite(USER_DATA_FILE, backend)
+            logger.warning(f"📦 Migradas {migrated} entradas de {USER_DATA_FILE} a {STATE_DB_FILE}")
+        return backend
+    return JsonFileBackend()
+
+class UserStateStore:
+    """Dueño en memoria de los datos de usuarios.
+
+    El backend se lee una sola vez al arrancar. Quien modifica el estado lo
+    hace bajo `lock` y marca la entrada con `mark_dirty` (opcionalmente solo
+    las banderas que cambiaron); `flush_if_due` escribe en lote cuando los
+    cambios llevan STATE_FLUSH_DEBOUNCE_SECONDS pendientes, y `flush` fuerza
+    la escritura (p. ej. al apagar).
+    """
+
+    def __init__(self, backend: Optional[StateBackend] = None):
+        self.backend = backend or JsonFileBackend()
+        self.data: Dict = {}
+        self.lock = threading.RLock()
+        self._dirty: DirtyMap = {}
+        self._dirty_since: Optional[float] = None
+        self._flush_lock = threading.Lock()
+        self.fenced = False     # Sin lease: ya no se escribe nada en el backend
+
+    def load(self, backend: Optional[StateBackend] = None) -> Dict:
+        with self.lock:
+            if backend is not None:
+                self.backend = backend
+            self.data = self.backend.load_all()
+            self._dirty.clear()
+            self._dirty_since = None
+            return self.data
+
+    def refresh(self) -> None:
+        """Relee el backend, escribiendo antes los cambios propios pendientes.
+
+        Actualiza `data` y cada entrada en el sitio, porque los hilos guardan
+        referencias a ellas. Lo usan los procesos del clúster para ver los
+        chats que otro proceso registró.
+        """
+        self.flush()
+        with self.lock:
+            fresh = self.backend.load_all()
+            for key in self._dirty:     # Cambios hechos mientras se releía
+                if key in self.data:
+                    fresh[key] = self.data[key]
+            for key in [key for key in self.data if key not in fresh]:
+                del self.data[key]
+            for key, value in fresh.items():
+                current = self.data.get(key)
+                if current is value:
+                    continue
+                if isinstance(current, dict) and isinstance(value, dict):
+                    current.clear()
+                    current.update(value)
+                else:
+                    self.data[key] = value
+
+    def fence(self) -> None:
+        """Bloquea las escrituras: otra instancia tiene ahora el lease."""
+        with self._flush_lock, self.lock:
+            self.fenced = True
+
+    def mark_dirty(self, key: str, flags: Optional[Iterable[str]] = None) -> None:
+        """Marca `key` como modificada; con `flags`, solo esas banderas."""
+        with self.lock:
+            if flags is None:
+                self._dirty[key] = None
+            elif key not in self._dirty:
+                self._dirty[key] = set(flags)
+            elif self._dirty[key] is not None:
+                self._dirty[key].update(flags)
+            if self._dirty_since is None:
+                self._dirty_since = time.time()
+
+    def dirty_count(self) -> int:
+        with self.lock:
+            return len(self._dirty)
+
+    def stats(self) -> Dict:
+        """Tamaño del estado: chats, banderas de notificación y cambios pendientes."""
+        with self.lock:
+            chats = [info for key, info in self.data.items() if not key.startswith('_') and isinstance(info, dict)]
+            flags = sum(len(info.get('last_notified_status', {})) for info in chats)
+            return {"chats": len(chats), "flags": flags, "dirty": len(self._dirty)}
+
+    def flush(self) -> bool:
+        """Escribe el estado si hay cambios pendientes. Retorna True si escribió."""
+        with self._flush_lock:
+            with self.lock:
+                if not self._dirty or self.fenced:
+                    return False
+                flushed, dirty_since = self._dirty, self._dirty_since
+                with PhaseTimer("save_collect"):
+                    changes = self.backend.collect_changes(self.data, flushed)
+                self._dirty, self._dirty_since = {}, None
+            with PhaseTimer("save_write"):
+                written = self.backend.apply_changes(changes)
+            if written:
+                stats = self.stats()
+                logger.info(f"💾 Estado guardado en {self.backend.name} ({len(flushed)} entradas modificadas; "
+                            f"{stats['chats']} chats, {stats['flags']} banderas)")
+                return True
+            # Reintentar en el próximo flush
+            with self.lock:
+                for key, flags in flushed.items():
+                    if flags is None:
+                        self.mark_dirty(key)
+                    else:
+                        self.mark_dirty(key, flags)
+                self._dirty_since = dirty_since
+            return False
+
+    def flush_if_due(self, debounce_seconds: float = STATE_FLUSH_DEBOUNCE_SECONDS) -> bool:
+        with self.lock:
+            due = self._dirty_since is not None and time.time() - self._dirty_since >= debounce_seconds
+        return self.flush() if due else False
+
+USER_STATE = UserStateStore()
 
 def send_telegram_message(chat_id: str, message: str) -> bool:
-    """Envía un mensaje a Telegram. Retorna True si fue exitoso."""
-    telegram_url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
+    """Encola un mensaje para Telegram en `TELEGRAM_OUTBOX`.
+
+    El envío real lo hace el despachador respetando los límites de la API.
+    Retorna True si el mensaje fue aceptado en la cola.
+    """
+    return TELEGRAM_OUTBOX.enqueue(str(chat_id), message)
+
+def post_telegram_message(chat_id: str, message: str) -> Tuple[str, Optional[float]]:
+    """Envía un mensaje a Telegram de forma síncrona.
+
+    Retorna (resultado, retry_after) con resultado en:
+    - "ok": enviado
+    - "retry": 429, 5xx o error de red; conviene reintentar (tras retry_after si vino)
+    - "blocked": el bot fue bloqueado o expulsado del chat (403)
+    - "rejected": Telegram rechazó este mensaje en particular (otro 4xx)
+    """
+    telegram_url = telegram_api_url("sendMessage")
     payload = {
         'chat_id': chat_id,
         'text': message,
         'parse_mode': 'Markdown'
     }
     try:
-        response = requests.post(telegram_url, data=payload, timeout=10)
-        response.raise_for_status()
-        return True
+        response = TELEGRAM_SESSION.post(
+            telegram_url, data=payload,
+            timeout=(HTTP_CONNECT_TIMEOUT_SECONDS, TELEGRAM_READ_TIMEOUT_SECONDS),
+        )
     except requests.exceptions.RequestException as e:
-        logger.error(f"Error al enviar mensaje a Telegram ({chat_id}): {e}")
-        return False
+        logger.warning(f"Error al enviar mensaje a Telegram ({chat_id}): {e}")
+        return "retry", None
+
+    if response.status_code == 200:
+        return "ok", None
+    if response.status_code == 429:
+        try:
+            retry_after = response.json().get('parameters', {}).get('retry_after')
+        except ValueError:
+            retry_after = None
+        return "retry", float(retry_after) if retry_after is not None else None
+    if response.status_code >= 500:
+        return "retry", None
+    logger.error(f"Error al enviar mensaje a Telegram ({chat_id}): {response.status_code} {response.text[:200]}")
+    return ("blocked" if response.status_code == 403 else "rejected"), None
 
 def calculate_animal_level(experience: int, xp_table: List[int]) -> int:
     """Calcula el nivel de un animal basándose en su XP."""
@@ -294,23 +939,568 @@ def parse_time_to_ms(value) -> Optional[float]:
 
     return None
 
-def fetch_farm_data(farm_id: str) -> Optional[Dict]:
-    """Obtiene los datos de la granja desde la API."""
-    url = f"https://api.sunflower-land.com/community/farms/{farm_id}"
-    headers = {"X-API-Key": API_KEY, "Content-Type": "application/json"}
-    
+class TokenBucket:
+    """Limitador token-bucket seguro entre hilos.
+
+    Cada petición consume un token; si no hay, el hilo espera lo necesario
+    para que el bucket se recargue. Varios hilos compartiendo el mismo bucket
+    nunca superan `rate_per_second` (más la ráfaga inicial de `capacity`).
+
+    Las peticiones de fondo pueden pedir un `reserve`: solo consumen si tras
+    ellas quedan al menos esos tokens libres, de modo que las peticiones
+    interactivas (reserve=0) casi nunca esperan detrás de un barrido.
+
+    También actúa como cortacircuitos global: `penalize` (la API respondió
+    429) pausa a todos los hilos y reduce la tasa a la mitad; `reward` la
+    recupera poco a poco con cada respuesta exitosa (AIMD).
+    """
+
+    def __init__(self, rate_per_second: float, capacity: float, min_rate_fraction: float = 1.0):
+        self.base_rate = max(rate_per_second, 1e-6)
+        self.rate = self.base_rate
+        self.min_rate = self.base_rate * min(max(min_rate_fraction, 0.0), 1.0)
+        self.capacity = max(float(capacity), 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._updated
+        self._updated = now
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+
+    def acquire(self, tokens: float = 1.0, reserve: float = 0.0) -> float:
+        """Consume `tokens` bloqueando lo necesario. Retorna los segundos esperados."""
+        needed = min(tokens + reserve, self.capacity)
+        start = time.monotonic()
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    self._cond.wait(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= needed:
+                    self._tokens -= tokens
+                    return now - start
+                self._cond.wait((needed - self._tokens) / self.rate)
+
+    def penalize(self, pause_seconds: float) -> None:
+        """Pausa a todos durante `pause_seconds` y reduce la tasa a la mitad."""
+        with self._cond:
+            self._refill(time.monotonic())
+            self._paused_until = max(self._paused_until, time.monotonic() + pause_seconds)
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = min(self._tokens, 0.0)
+
+    def set_base_rate(self, rate_per_second: float) -> None:
+        """Cambia la tasa base (p. ej. al repartir la cuota entre procesos)."""
+        with self._cond:
+            self._refill(time.monotonic())
+            scale = max(rate_per_second, 1e-6) / self.base_rate
+            self.base_rate *= scale
+            self.min_rate *= scale
+            self.rate *= scale      # Conserva la reducción por 429 si la había
+            self._cond.notify_all()
+
+    def reward(self) -> None:
+        """Recupera la tasa un 10% de la base tras una respuesta exitosa."""
+        if self.rate >= self.base_rate:
+            return
+        with self._cond:
+            self._refill(time.monotonic())
+            self.rate = min(self.base_rate, self.rate + self.base_rate * 0.1)
+
+class FarmCircuitBreaker:
+    """Cortacircuitos por granja.
+
+    Tras FARM_BREAKER_FAILURE_THRESHOLD fallos seguidos la granja queda
+    aparcada (no se consulta) durante un tiempo que se duplica cada vez que
+    vuelve a fallar, hasta FARM_BREAKER_MAX_COOLDOWN_SECONDS. Pasado ese
+    tiempo se permite un intento; un éxito la rehabilita por completo.
+    """
+
+    def __init__(self, failure_threshold: int, cooldown_seconds: float, max_cooldown_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.max_cooldown_seconds = max_cooldown_seconds
+        self._failures: Dict[str, int] = {}
+        self._open_until: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def allow(self, farm_id: str) -> bool:
+        with self._lock:
+            return time.time() >= self._open_until.get(farm_id, 0.0)
+
+    def open_until(self, farm_id: str) -> float:
+        with self._lock:
+            return self._open_until.get(farm_id, 0.0)
+
+    def record_success(self, farm_id: str) -> None:
+        with self._lock:
+            self._failures.pop(farm_id, None)
+            self._open_until.pop(farm_id, None)
+
+    def record_failure(self, farm_id: str) -> None:
+        with self._lock:
+            failures = self._failures.get(farm_id, 0) + 1
+            self._failures[farm_id] = failures
+            if failures < self.failure_threshold:
+                return
+            reopenings = failures - self.failure_threshold
+            cooldown = min(self.max_cooldown_seconds, self.cooldown_seconds * (2 ** reopenings))
+            self._open_until[farm_id] = time.time() + cooldown
+        logger.warning(f"🔌 Farm ID {farm_id} aparcada {cooldown:.0f}s tras {failures} fallos seguidos")
+
+    def open_count(self) -> int:
+        now = time.time()
+        with self._lock:
+            return sum(1 for until in self._open_until.values() if until > now)
+
+# Limitador global: todas las llamadas a la API de Sunflower Land pasan por aquí
+SFL_API_LIMITER = TokenBucket(SFL_API_REQUESTS_PER_MINUTE / 60.0, SFL_API_BURST, SFL_API_MIN_RATE_FRACTION)
+FARM_BREAKER = FarmCircuitBreaker(FARM_BREAKER_FAILURE_THRESHOLD, FARM_BREAKER_COOLDOWN_SECONDS,
+                                  FARM_BREAKER_MAX_COOLDOWN_SECONDS)
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Interpreta la cabecera Retry-After (segundos o fecha HTTP). None si no hay."""
+    if not value:
+        return None
     try:
-        response = requests.get(url, headers=headers, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        logger.info(f"[DEBUG] API Response URL: {url}")
-        logger.info(f"[DEBUG] API Response Headers: {headers}")
-        logger.info(f"[DEBUG] API Response Data: {json.dumps(data, indent=2)}")
-        return data
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error al obtener datos de Farm ID {farm_id}: {e}")
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def compute_backoff_seconds(attempt: int, retry_after: Optional[float] = None) -> float:
+    """Espera antes del reintento `attempt` (0, 1, ...): Retry-After si la API lo
+    indicó, o backoff exponencial con jitter completo."""
+    if retry_after is not None:
+        return min(retry_after, SFL_API_BACKOFF_MAX_SECONDS)
+    ceiling = min(SFL_API_BACKOFF_MAX_SECONDS, SFL_API_BACKOFF_BASE_SECONDS * (2 ** attempt))
+    return random.uniform(ceiling / 2, ceiling)
+
+class TelegramOutbox:
+    """Cola de salida de mensajes de Telegram con un hilo despachador.
+
+    - Límite global: TokenBucket de TELEGRAM_MESSAGES_PER_SECOND.
+    - Límite por chat: un envío cada TELEGRAM_PER_CHAT_INTERVAL_SECONDS; un
+      heap de (próximo envío permitido, chat) decide a quién le toca.
+    - Coalescencia: los mensajes pendientes de un mismo chat se combinan en
+      uno solo mientras quepan en TELEGRAM_MAX_MESSAGE_LENGTH.
+    - 429: el chat se reprograma tras el `retry_after` que indica Telegram.
+    - 403: el bot fue bloqueado; se descarta lo pendiente de ese chat y el
+      resto de chats sigue su curso.
+    """
+
+    def __init__(self, messages_per_second: float, per_chat_interval: float):
+        self.per_chat_interval = per_chat_interval
+        self._limiter = TokenBucket(messages_per_second, messages_per_second)
+        self._pending: Dict[str, List[str]] = {}
+        self._inflight = set()
+        self._attempts: Dict[str, int] = {}
+        self._next_send: Dict[str, float] = {}
+        self._heap: List[Tuple[float, int, str]] = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self.sent = 0
+        self.failed = 0
+        self.coalesced = 0
+
+    def enqueue(self, chat_id: str, text: str) -> bool:
+        with self._cond:
+            parts = self._pending.setdefault(chat_id, [])
+            parts.append(text)
+            if len(parts) == 1 and chat_id not in self._inflight:
+                self._schedule(chat_id)
+            self._cond.notify()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="telegram-outbox", daemon=True)
+                self._thread.start()
+        return True
+
+    def pending_count(self) -> int:
+        with self._cond:
+            return sum(len(parts) for parts in self._pending.values()) + len(self._inflight)
+
+    def set_rate(self, messages_per_second: float) -> None:
+        self._limiter.set_base_rate(messages_per_second)
+
+    def drain(self, timeout: float) -> bool:
+        """Espera a que la cola se vacíe (p. ej. al apagar). Retorna True si se vació."""
+        deadline = time.time() + timeout
+        with self._cond:
+            while self._pending or self._inflight:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def _schedule(self, chat_id: str) -> None:
+        heapq.heappush(self._heap, (self._next_send.get(chat_id, 0.0), next(self._seq), chat_id))
+
+    def _take_batch(self, chat_id: str) -> Tuple[str, int]:
+        """Saca de la cola del chat tantos mensajes como quepan en uno."""
+        parts = self._pending[chat_id]
+        batch = [parts.pop(0)]
+        length = len(batch[0])
+        while parts and length + 2 + len(parts[0]) <= TELEGRAM_MAX_MESSAGE_LENGTH:
+            length += 2 + len(parts[0])
+            batch.append(parts.pop(0))
+        if not parts:
+            del self._pending[chat_id]
+        self.coalesced += len(batch) - 1
+        return "\n\n".join(batch), len(batch)
+
+    def _next_job(self) -> Tuple[str, str, int]:
+        with self._cond:
+            while True:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                send_at, _, chat_id = self._heap[0]
+                now = time.time()
+                if send_at > now:
+                    self._cond.wait(send_at - now)
+                    continue
+                heapq.heappop(self._heap)
+                if chat_id not in self._pending:
+                    continue
+                text, count = self._take_batch(chat_id)
+                self._inflight.add(chat_id)
+                return chat_id, text, count
+
+    def _run(self) -> None:
+        while True:
+            chat_id, text, count = self._next_job()
+            self._limiter.acquire()
+            try:
+                outcome, retry_after = post_telegram_message(chat_id, text)
+            except Exception as e:
+                logger.exception(f"🚨 Error inesperado enviando a {chat_id}: {e}")
+                outcome, retry_after = "rejected", None
+
+            with self._cond:
+                self._inflight.discard(chat_id)
+                now = time.time()
+                if outcome == "ok":
+                    self.sent += count
+                    self._attempts.pop(chat_id, None)
+                    self._next_send[chat_id] = now + self.per_chat_interval
+                elif outcome == "retry":
+                    attempts = self._attempts.get(chat_id, 0) + 1
+                    if attempts > TELEGRAM_SEND_MAX_RETRIES:
+                        logger.error(f"Mensaje a {chat_id} descartado tras {attempts - 1} reintentos")
+                        self.failed += count
+                        self._attempts.pop(chat_id, None)
+                    else:
+                        self._attempts[chat_id] = attempts
+                        self._pending.setdefault(chat_id, []).insert(0, text)
+                        delay = retry_after if retry_after is not None else compute_backoff_seconds(attempts - 1)
+                        self._next_send[chat_id] = now + max(delay, self.per_chat_interval)
+                elif outcome == "blocked":
+                    dropped = count + len(self._pending.pop(chat_id, []))
+                    self.failed += dropped
+                    self._attempts.pop(chat_id, None)
+                    logger.warning(f"🚫 Chat {chat_id} bloqueó al bot; {dropped} mensajes descartados")
+                else:
+                    self.failed += count
+                    self._attempts.pop(chat_id, None)
+
+                if chat_id in self._pending:
+                    self._schedule(chat_id)
+                if len(self._next_send) > 1024:
+                    # Olvidar turnos ya vencidos para no crecer con cada chat visto
+                    self._next_send = {c: t for c, t in self._next_send.items() if t > now}
+                self._cond.notify_all()
+
+TELEGRAM_OUTBOX = TelegramOutbox(TELEGRAM_MESSAGES_PER_SECOND, TELEGRAM_PER_CHAT_INTERVAL_SECONDS)
+
+class FarmSnapshotCache:
+    """Caché LRU en memoria de snapshots de granja, con TTL y límite de memoria.
+
+    El tamaño de cada entrada es el del cuerpo HTTP recibido, una aproximación
+    suficiente para acotar la memoria sin recorrer el dict decodificado.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, Tuple[float, int, Dict]]" = OrderedDict()
+        self._bytes = 0
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, farm_id: str) -> Optional[Tuple[Dict, float]]:
+        """Retorna (datos, antigüedad en segundos) o None si la granja no está en caché."""
+        with self._lock:
+            entry = self._entries.get(farm_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(farm_id)
+            self.hits += 1
+            stored_at, _, data = entry
+            return data, time.time() - stored_at
+
+    def peek(self, farm_id: str) -> Optional[Tuple[Dict, float]]:
+        """Como `lookup`, pero sin contarlo como consulta ni cambiar su posición en el LRU."""
+        with self._lock:
+            entry = self._entries.get(farm_id)
+            if entry is None:
+                return None
+            stored_at, _, data = entry
+            return data, time.time() - stored_at
+
+    def put(self, farm_id: str, data: Dict, size_bytes: int) -> None:
+        with self._lock:
+            old = self._entries.pop(farm_id, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[farm_id] = (time.time(), size_bytes, data)
+            self._bytes += size_bytes
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def begin_refresh(self, farm_id: str) -> bool:
+        """Marca un refresco en curso. Retorna False si ya había uno para esa granja."""
+        with self._lock:
+            if farm_id in self._refreshing:
+                return False
+            self._refreshing.add(farm_id)
+            return True
+
+    def end_refresh(self, farm_id: str) -> None:
+        with self._lock:
+            self._refreshing.discard(farm_id)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes,
+                    "hits": self.hits, "misses": self.misses}
+
+FARM_CACHE = FarmSnapshotCache(FARM_CACHE_MAX_ENTRIES, FARM_CACHE_MAX_BYTES)
+
+class KeyedRateLimiter:
+    """Token-bucket no bloqueante con un bucket por clave (chat o granja).
+
+    A diferencia de TokenBucket, nunca espera: `wait_time` dice cuánto falta
+    para el próximo token y el llamador decide qué responder. Lleva además
+    contadores de permitidas/limitadas por clave para ver quién gasta la cuota
+    (como mucho `max_keys`; al llenarse se quedan las claves con más
+    consultas) y totales que nunca se recortan.
+    """
+
+    def __init__(self, per_minute: float, capacity: int, max_keys: int = 10000):
+        self.rate = max(per_minute, 1e-6) / 60.0
+        self.capacity = max(float(capacity), 1.0)
+        self.max_keys = max_keys
+        self._buckets: Dict[str, Tuple[float, float]] = {}   # clave -> (tokens, actualizado)
+        self._counters: Dict[str, List[int]] = {}            # clave -> [permitidas, limitadas]
+        self.allowed_total = 0
+        self.throttled_total = 0
+        self._lock = threading.Lock()
+
+    def _count(self, key: str, column: int) -> None:
+        """Suma uno a la columna de `key` (0 permitidas, 1 limitadas). Llamar con el lock."""
+        counters = self._counters.get(key)
+        if counters is None:
+            if len(self._counters) >= self.max_keys:
+                busiest = sorted(self._counters.items(), key=lambda item: item[1][0] + item[1][1], reverse=True)
+                self._counters = dict(busiest[:self.max_keys // 2])
+            counters = self._counters[key] = [0, 0]
+        counters[column] += 1
+
+    def _tokens(self, key: str, now: float) -> float:
+        tokens, updated = self._buckets.get(key, (self.capacity, now))
+        return min(self.capacity, tokens + (now - updated) * self.rate)
+
+    def wait_time(self, key: str) -> float:
+        """Segundos hasta que `key` tenga un token (0 si ya lo tiene)."""
+        with self._lock:
+            tokens = self._tokens(key, time.monotonic())
+            return 0.0 if tokens >= 1.0 else (1.0 - tokens) / self.rate
+
+    def consume(self, key: str) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self._buckets[key] = (self._tokens(key, now) - 1.0, now)
+            self._count(key, 0)
+            self.allowed_total += 1
+            if len(self._buckets) > self.max_keys:
+                # Un bucket lleno equivale a no tenerlo: se puede olvidar
+                self._buckets = {k: v for k, v in self._buckets.items() if self._tokens(k, now) < self.capacity}
+
+    def record_throttled(self, key: str) -> None:
+        with self._lock:
+            self._count(key, 1)
+            self.throttled_total += 1
+
+    def stats(self, top: int = 10) -> List[Tuple[str, int, int]]:
+        """Las `top` claves con más consultas: (clave, permitidas, limitadas)."""
+        with self._lock:
+            rows = [(key, allowed, throttled) for key, (allowed, throttled) in self._counters.items()]
+        rows.sort(key=lambda row: row[1] + row[2], reverse=True)
+        return rows[:top]
+
+COMMAND_CHAT_LIMITER = KeyedRateLimiter(COMMAND_CHAT_PER_MINUTE, COMMAND_CHAT_BURST)
+COMMAND_FARM_LIMITER = KeyedRateLimiter(COMMAND_FARM_PER_MINUTE, COMMAND_FARM_BURST)
+
+# Marca por hilo: el comando en curso debe responder solo desde la caché
+COMMAND_SCOPE = threading.local()
+
+# Subárboles de `farm` que lee build_farm_index (de floatingIsland solo `schedule`)
+FARM_PAYLOAD_FIELDS = ("crops", "trees", "stones", "beehives")
+
+def project_farm_payload(payload: Dict) -> Dict:
+    """Reduce la respuesta de la API a {"farm": {...}} con solo los subárboles que se usan."""
+    farm = payload.get("farm")
+    if not isinstance(farm, dict):
+        return {"farm": {}}
+    projected = {key: farm[key] for key in FARM_PAYLOAD_FIELDS if key in farm}
+    island = farm.get("floatingIsland")
+    if isinstance(island, dict) and "schedule" in island:
+        projected["floatingIsland"] = {"schedule": island["schedule"]}
+    return {"farm": projected}
+
+def decode_farm_payload(raw: bytes) -> Dict:
+    """Decodifica el cuerpo de /community/farms y lo proyecta de inmediato.
+
+    Usa orjson si está instalado. El árbol completo (inventario, edificios,
+    bumpkin...) solo vive durante esta llamada; lo que queda en caché y
+    comparten comandos y monitor es la proyección. Lanza ValueError si el
+    cuerpo no es un objeto JSON.
+    """
+    payload = orjson.loads(raw) if orjson is not None else json.loads(raw)
+    if not isinstance(payload, dict):
+        raise ValueError(f"respuesta inesperada de la API ({type(payload).__name__})")
+    return project_farm_payload(payload)
+
+def fetch_farm_data(farm_id: str, background: bool = False) -> Optional[Dict]:
+    """Obtiene los datos de la granja desde la API.
+
+    Las descargas de fondo (`background`) ceden la cuota a los comandos.
+    Los 429, 5xx y errores de red se reintentan con backoff exponencial (o lo
+    que indique Retry-After); un 429 además frena a todos vía
+    `SFL_API_LIMITER.penalize`. Las granjas que fallan una y otra vez quedan
+    aparcadas por `FARM_BREAKER`.
+    """
+    if not FARM_BREAKER.allow(farm_id):
+        logger.info(f"🔌 Farm ID {farm_id} aparcada; se omite la consulta")
         return None
 
+    url = f"{SFL_API_BASE_URL}/community/farms/{farm_id}"
+    headers = {"X-API-Key": API_KEY, "Content-Type": "application/json"}
+    max_retries = SFL_API_MAX_RETRIES if background else min(1, SFL_API_MAX_RETRIES)
+    fetch_kind = "monitor" if background else "command"
+    
+    for attempt in range(max_retries + 1):
+        waited = SFL_API_LIMITER.acquire(reserve=SFL_API_COMMAND_RESERVE if background else 0.0)
+        METRICS.observe("sfl_sweep_phase_seconds", waited, phase="quota_wait")
+        if waited >= 0.1:
+            log_event(logging.INFO, "api_quota_wait", farm_id=farm_id, seconds=f"{waited:.1f}")
+
+        retry_after = None
+        response = None
+        started = time.perf_counter()
+        try:
+            response = SFL_SESSION.get(
+                url, headers=headers,
+                timeout=(HTTP_CONNECT_TIMEOUT_SECONDS, SFL_READ_TIMEOUT_SECONDS),
+            )
+            elapsed = time.perf_counter() - started
+            METRICS.observe("sfl_farm_fetch_duration_seconds", elapsed, kind=fetch_kind)
+            METRICS.observe("sfl_sweep_phase_seconds", elapsed, phase="http")
+            METRICS.inc("sfl_farm_fetch_responses_total", code=str(response.status_code))
+            if response.status_code == 429:
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                SFL_API_LIMITER.penalize(compute_backoff_seconds(attempt, retry_after))
+            response.raise_for_status()
+            with PhaseTimer("decode"):
+                data = decode_farm_payload(response.content)
+        except requests.exceptions.HTTPError as e:
+            status = e.response.status_code if e.response is not None else None
+            if status is not None and status != 429 and status < 500:
+                # Errores del cliente (p. ej. granja inexistente): reintentar no sirve
+                logger.error(f"Error al obtener datos de Farm ID {farm_id}: {e}")
+                FARM_BREAKER.record_failure(farm_id)
+                return None
+            last_error = e
+        except requests.exceptions.RequestException as e:
+            if response is None:
+                METRICS.inc("sfl_farm_fetch_responses_total", code="error")
+            last_error = e
+        except ValueError as e:
+            # Cuerpo truncado o que no es JSON: se reintenta como un error de red
+            last_error = e
+        else:
+            SFL_API_LIMITER.reward()
+            FARM_BREAKER.record_success(farm_id)
+            with PhaseTimer("index"):
+                FARM_INDEX_HISTORY.attach(farm_id, data, response.content)
+            FARM_CACHE.put(farm_id, data, len(response.content))
+            log_event(logging.DEBUG, "farm_fetched", farm_id=farm_id, status=response.status_code,
+                      bytes=len(response.content), attempt=attempt)
+            capture_payload("farm", farm_id, response.content)
+            return data
+
+        if attempt == max_retries:
+            break
+        delay = compute_backoff_seconds(attempt, retry_after)
+        if not background and delay > COMMAND_MAX_RETRY_WAIT_SECONDS:
+            break
+        logger.warning(f"Reintento {attempt + 1}/{max_retries} de Farm ID {farm_id} en {delay:.1f}s: {last_error}")
+        time.sleep(delay)
+
+    logger.error(f"Error al obtener datos de Farm ID {farm_id}: {last_error}")
+    FARM_BREAKER.record_failure(farm_id)
+    return None
+
+def _refresh_farm_in_background(farm_id: str) -> None:
+    """Lanza un refresco de la granja en segundo plano (uno a la vez por granja)."""
+    if not FARM_CACHE.begin_refresh(farm_id):
+        return
+
+    def _run() -> None:
+        try:
+            fetch_farm_data(farm_id, background=True)
+        finally:
+            FARM_CACHE.end_refresh(farm_id)
+
+    threading.Thread(target=_run, name=f"farm-refresh-{farm_id}", daemon=True).start()
+
+def get_farm_data(farm_id: str, allow_stale: bool = True) -> Optional[Dict]:
+    """Obtiene los datos de la granja pasando primero por `FARM_CACHE`.
+
+    Si el snapshot tiene menos de FARM_CACHE_TTL_SECONDS se usa tal cual. Con
+    `allow_stale`, un snapshot algo más viejo (hasta FARM_CACHE_STALE_SECONDS
+    extra) se devuelve de inmediato mientras se refresca en segundo plano.
+    En cualquier otro caso se consulta la API.
+
+    Si el comando en curso fue limitado (`COMMAND_SCOPE.cache_only`) se
+    devuelve lo que haya en caché, sea cual sea su antigüedad.
+    """
+    cached = FARM_CACHE.lookup(farm_id)
+    if getattr(COMMAND_SCOPE, 'cache_only', False):
+        return cached[0] if cached is not None else None
+    if cached is not None:
+        data, age_seconds = cached
+        if age_seconds <= FARM_CACHE_TTL_SECONDS:
+            return data
+        if allow_stale and age_seconds <= FARM_CACHE_TTL_SECONDS + FARM_CACHE_STALE_SECONDS:
+            _refresh_farm_in_background(farm_id)
+            return data
+    return fetch_farm_data(farm_id)
+
 def calculate_crop_ready_time(crop_data: Dict) -> Optional[float]:
     """Calcula el tiempo de cosecha de un cultivo."""
     crop_name = crop_data.get("name")
@@ -356,11 +1546,287 @@ Módulos de procesamiento para cada tipo de recurso:
 Cada módulo incluye:
 1. Función process_X_alerts: Para notificaciones automáticas
 2. Función para comando manual (/beehive, /crops, etc.)
+
+Todos leen el FarmTimerIndex del snapshot (analyze_farm), que recorre el
+payload una sola vez y guarda los tiempos de cada tipo de recurso. Entre
+snapshots de una misma granja solo se recalcula lo que cambió
+(FARM_INDEX_HISTORY), y las alertas de cultivos, árboles y piedras avisan de
+cada nuevo grupo de recursos listos (marca `<tipo>_ready_until`).
 """
 
+class TimerTable:
+    """Tiempos de un tipo de recurso en columnas paralelas, en el orden del payload.
+
+    `total` cuenta todas las entradas del payload (también las que no tienen
+    tiempo), para distinguir "no hay recursos" de "no hay información".
+
+    `finalize` copia `ready_at` a un array de NumPy (NaN donde no hay tiempo)
+    si la tabla es grande y NumPy está instalado; las consultas usan entonces
+    operaciones vectorizadas y si no, bucles de Python con el mismo resultado.
+    """
+    __slots__ = ('ids', 'names', 'ready_at', 'total', '_array')
+
+    def __init__(self):
+        self.ids: List[str] = []
+        self.names: List[Optional[str]] = []
+        self.ready_at: List[Optional[float]] = []
+        self.total = 0
+        self._array = None
+
+    def add(self, resource_id: str, name: Optional[str], ready_at_ms: Optional[float]) -> None:
+        self.ids.append(resource_id)
+        self.names.append(name)
+        self.ready_at.append(ready_at_ms)
+
+    def finalize(self) -> None:
+        if numpy is not None and len(self.ready_at) >= TIMER_VECTORIZE_MIN_RESOURCES:
+            self._array = numpy.array(self.ready_at, dtype=numpy.float64)   # None -> NaN
+
+    def ready_between(self, after_ms: float, current_time_ms: float) -> List[Tuple[str, float]]:
+        """Recursos que pasaron a listos en (after_ms, current_time_ms]: [(id, ready_at), ...]."""
+        if self._array is not None:
+            mask = (self._array > after_ms) & (self._array <= current_time_ms) & (self._array != 0)
+            return [(self.ids[i], self.ready_at[i]) for i in numpy.flatnonzero(mask).tolist()]
+        return [(resource_id, r) for resource_id, r in zip(self.ids, self.ready_at)
+                if r and after_ms < r <= current_time_ms]
+
+    def next_ready(self, current_time_ms: float) -> Optional[float]:
+        if self._array is not None:
+            pending = self._array[self._array > current_time_ms]
+            return float(pending.min()) if pending.size else None
+        return min((r for r in self.ready_at if r is not None and r > current_time_ms), default=None)
+
+def crop_ready_times(planted_at: List, crop_names: List[str]) -> List[Optional[float]]:
+    """Calcula en bloque lo mismo que calculate_crop_ready_time para cada cultivo.
+
+    Con NumPy y suficientes cultivos, los plantedAt numéricos se convierten y
+    suman a su tiempo base con operaciones vectorizadas (las cadenas ISO, poco
+    frecuentes, siguen pasando por parse_time_to_ms). El resultado es idéntico
+    al de la ruta en Python puro.
+    """
+    base_times = [CROP_BASE_TIMES_MS.get(name) for name in crop_names]
+    if numpy is None or len(planted_at) < TIMER_VECTORIZE_MIN_RESOURCES:
+        ready = []
+        for raw, base_ms in zip(planted_at, base_times):
+            planted_at_ms = parse_time_to_ms(raw) if base_ms is not None else None
+            ready.append(None if planted_at_ms is None else planted_at_ms + float(base_ms))
+        return ready
+
+    # Las cadenas (fechas ISO) se parsean aparte; el resto se convierte en bloque
+    text_positions = [i for i, raw in enumerate(planted_at) if isinstance(raw, str)]
+    numeric = planted_at
+    if text_positions:
+        numeric = list(planted_at)
+        for i in text_positions:
+            numeric[i] = None
+    try:
+        raw_ms = numpy.array(numeric, dtype=numpy.float64)   # None -> NaN
+    except (TypeError, ValueError):
+        return [calculate_crop_ready_time({"name": name, "plantedAt": raw})
+                for raw, name in zip(planted_at, crop_names)]
+    planted_ms = numpy.where(raw_ms > 1e12, raw_ms, raw_ms * 1000.0)
+    for i in text_positions:
+        parsed = parse_time_to_ms(planted_at[i])
+        planted_ms[i] = numpy.nan if parsed is None else parsed
+    ready_ms = planted_ms + numpy.array(base_times, dtype=numpy.float64)
+    if not numpy.isnan(ready_ms).any():
+        return ready_ms.tolist()
+    return [None if r != r else r for r in ready_ms.tolist()]   # NaN -> None
+
+class BeehiveTimer:
+    """Estado de una colmena: fin de producción (attachedUntil) y swarm."""
+    __slots__ = ('hive_id', 'swarm', 'attached_until_ms')
+
+    def __init__(self, hive_id: str, swarm: bool, attached_until_ms: float):
+        self.hive_id = hive_id
+        self.swarm = swarm
+        self.attached_until_ms = attached_until_ms
+
+class FarmTimerIndex:
+    """Índice de todos los temporizadores de un snapshot, calculado una sola vez.
+
+    Lo leen tanto los procesadores de alertas como los comandos de estado, así
+    que un snapshot se recorre una vez por mucho chat que comparta la granja.
+    `beehive_ids` es None si el payload no trae la clave `beehives`.
+    """
+    __slots__ = ('crops', 'trees', 'stones', 'beehives', 'beehive_ids', 'island_schedule', 'island_events')
+
+    def __init__(self):
+        self.crops = TimerTable()
+        self.trees = TimerTable()
+        self.stones = TimerTable()
+        self.beehives: List[BeehiveTimer] = []
+        self.beehive_ids: Optional[Set[str]] = None
+        self.island_schedule: List[Dict] = []
+        self.island_events: List[Tuple[float, float]] = []
+
+def build_farm_index(farm: Dict, previous: Optional[Tuple[Dict, FarmTimerIndex]] = None) -> FarmTimerIndex:
+    """Recorre `farm` una vez y arma su FarmTimerIndex.
+
+    Con `previous` (farm e índice del snapshot anterior), las tablas de
+    cultivos, árboles y piedras cuyo sub-dict no cambió se reutilizan sin
+    recalcularlas.
+    """
+    index = FarmTimerIndex()
+    prev_farm, prev_index = previous if previous is not None else ({}, None)
+    reused = set()
+    if prev_index is not None:
+        for kind in ("crops", "trees", "stones"):
+            if kind in farm and farm[kind] == prev_farm.get(kind):
+                setattr(index, kind, getattr(prev_index, kind))
+                reused.add(kind)
+
+    plots = farm.get("crops") or {}
+    if "crops" not in reused and isinstance(plots, dict):
+        index.crops.total = len(plots)
+        planted_at = []
+        for plot_id, plot_data in plots.items():
+            crop_data = plot_data.get("crop", {})
+            if crop_data and crop_data.get("name"):
+                index.crops.ids.append(plot_id)
+                index.crops.names.append(crop_data["name"])
+                planted_at.append(crop_data.get("plantedAt"))
+        index.crops.ready_at = crop_ready_times(planted_at, index.crops.names)
+
+    if "trees" not in reused:
+        trees = farm.get("trees") or {}
+        index.trees.total = len(trees)
+        for tree_id, tree_data in trees.items():
+            chopped_at_ms = tree_data.get("wood", {}).get("choppedAt")
+            if chopped_at_ms:
+                index.trees.add(tree_id, None, chopped_at_ms + TREE_GROWTH_BASE_MS)
+
+    if "stones" not in reused:
+        stones = farm.get("stones") or {}
+        index.stones.total = len(stones)
+        for stone_id, stone_data in stones.items():
+            mined_at_ms = stone_data.get("stone", {}).get("minedAt")
+            if mined_at_ms:
+                index.stones.add(stone_id, None, mined_at_ms + STONE_RESPAWN_BASE_MS)
+
+    if "beehives" in farm:
+        beehives = farm.get("beehives") or {}
+        index.beehive_ids = set(beehives.keys())
+        for beehive_id, hive_data in beehives.items():
+            flowers = hive_data.get("flowers", [])
+            attached_until_ms = max((f.get("attachedUntil", 0) for f in flowers), default=0)
+            index.beehives.append(BeehiveTimer(beehive_id, hive_data.get("swarm", False), attached_until_ms))
+
+    index.island_schedule = (farm.get("floatingIsland") or {}).get("schedule", []) or []
+    for event in index.island_schedule:
+        start_time_ms = event.get("startAt")
+        end_time_ms = event.get("endAt")
+        if start_time_ms and end_time_ms:
+            index.island_events.append((start_time_ms, end_time_ms))
+
+    for kind in ("crops", "trees", "stones"):
+        if kind not in reused:
+            getattr(index, kind).finalize()
+    return index
+
+def analyze_farm(data: Dict) -> FarmTimerIndex:
+    """Retorna el FarmTimerIndex de un snapshot, construyéndolo la primera vez.
+
+    El índice se guarda dentro del propio snapshot (clave `_timer_index`), que
+    es el mismo objeto que comparten la caché, el monitor y los comandos.
+    """
+    index = data.get("_timer_index")
+    if index is None:
+        index = build_farm_index(data.get("farm", {}))
+        data["_timer_index"] = index
+    return index
+
+class FarmIndexHistory:
+    """Reutiliza el análisis del snapshot anterior de cada granja (el que sigue en caché).
+
+    Cada snapshot guarda el digest de su cuerpo HTTP (clave `_body_digest`).
+    Si el cuerpo no cambió se reutiliza el índice tal cual; si cambió, solo se
+    recalculan los tipos de recurso cuyo contenido es distinto. No retiene
+    nada propio: lo anterior se lee de `cache`, así que cuando la caché
+    descarta una granja por su límite de memoria, el índice se va con ella.
+    """
+
+    def __init__(self, cache: FarmSnapshotCache):
+        self._cache = cache
+        self._lock = threading.Lock()
+        self.unchanged = 0
+        self.rebuilt = 0
+
+    def attach(self, farm_id: str, data: Dict, raw: bytes) -> FarmTimerIndex:
+        """Calcula (o reutiliza) el índice de `data` y lo deja en `data['_timer_index']`.
+
+        Llamar antes de guardar `data` en la caché, mientras esta todavía
+        tiene el snapshot anterior.
+        """
+        digest = hashlib.blake2b(raw, digest_size=16).digest()
+        cached = self._cache.peek(farm_id)
+        previous = cached[0] if cached is not None else None
+        prev_index = previous.get("_timer_index") if previous is not None else None
+        if prev_index is not None and previous.get("_body_digest") == digest:
+            index = prev_index
+            with self._lock:
+                self.unchanged += 1
+        else:
+            index = build_farm_index(data.get("farm", {}),
+                                     (previous.get("farm", {}), prev_index) if prev_index is not None else None)
+            with self._lock:
+                self.rebuilt += 1
+        data["_body_digest"] = digest
+        data["_timer_index"] = index
+        return index
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"unchanged": self.unchanged, "rebuilt": self.rebuilt}
+
+FARM_INDEX_HISTORY = FarmIndexHistory(FARM_CACHE)
+
+def advance_ready_watermark(table: TimerTable, last_status: Dict, kind: str, current_time_ms: float,
+                            fetched_at_ms: Optional[float] = None) -> int:
+    """Cuenta los recursos de `table` que pasaron a listos desde el último aviso.
+
+    La bandera `<kind>_ready_until` es la marca de agua: todo recurso con
+    ready_at posterior que ya esté listo es nuevo, aunque los anteriores sigan
+    sin recogerse. La marca avanza hasta `fetched_at_ms` (cuándo se descargó
+    el snapshot) y nunca más allá: un recurso plantado después no está en el
+    snapshot y su ready_at será posterior a esa hora, así que no queda tapado.
+    Los recursos ya avisados por encima de la marca (listos entre la descarga
+    y `current_time_ms`) se guardan como [id, ready_at] en `<kind>_ready_ahead`
+    para no repetir su aviso. Reemplaza a la bandera booleana `<kind>_ready`,
+    que se migra sin repetir el aviso ya enviado.
+    """
+    if fetched_at_ms is None:
+        fetched_at_ms = current_time_ms
+    watermark_key = f"{kind}_ready_until"
+    ahead_key = f"{kind}_ready_ahead"
+    legacy_key = f"{kind}_ready"
+    if legacy_key in last_status:
+        already_notified = last_status.pop(legacy_key)
+        if watermark_key not in last_status:
+            ready = table.ready_between(0, current_time_ms) if already_notified else []
+            latest = max((r for _, r in ready), default=0)
+            last_status[watermark_key] = min(latest, fetched_at_ms)
+            ahead = [[resource_id, r] for resource_id, r in ready if r > last_status[watermark_key]]
+            if ahead:
+                last_status[ahead_key] = ahead
+    watermark = last_status.get(watermark_key, 0)
+    announced = {(resource_id, r) for resource_id, r in last_status.get(ahead_key, [])}
+
+    ready = table.ready_between(watermark, current_time_ms)
+    newly_ready = [entry for entry in ready if entry not in announced]
+    if not newly_ready:
+        return 0
+    # Todo lo del snapshot listo hasta su descarga ya quedó avisado
+    new_watermark = max(watermark, fetched_at_ms)
+    last_status[watermark_key] = new_watermark
+    ahead = [[resource_id, r] for resource_id, r in ready if r > new_watermark]
+    if ahead or ahead_key in last_status:
+        last_status[ahead_key] = ahead
+    return len(newly_ready)
+
 def process_beehives(data: Dict, user_info: Dict, current_time_ms: float) -> Tuple[List[str], List[str]]:
     """Procesa los datos de las colmenas."""
-    beehives = data.get("farm", {}).get("beehives", {})
+    beehives = analyze_farm(data).beehives
     last_status = user_info.get('last_notified_status', {})
     
     status_messages = []
@@ -369,12 +1835,11 @@ def process_beehives(data: Dict, user_info: Dict, current_time_ms: float) -> Tup
     if not beehives:
         return status_messages, one_time_alerts
 
-    for beehive_id, hive_data in beehives.items():
-        swarm_status = hive_data.get("swarm", False)
-        flowers = hive_data.get("flowers", [])
-        attached_until_ms = max((f.get("attachedUntil", 0) for f in flowers), default=0)
+    for hive in beehives:
+        beehive_id = hive.hive_id
+        attached_until_ms = hive.attached_until_ms
 
-        swarm_text = "VERDADERO" if swarm_status else "FALSO"
+        swarm_text = "VERDADERO" if hive.swarm else "FALSO"
         production_key = f"beehive_{beehive_id}_finished"
 
         message_lines = [f"🐝 *Colmena #{beehive_id}*"]
@@ -398,122 +1863,70 @@ def process_beehives(data: Dict, user_info: Dict, current_time_ms: float) -> Tup
 
 def process_crops_status(data: Dict, current_time_ms: float) -> List[str]:
     """Calcula el tiempo restante de los cultivos para el comando /crops."""
-    plots = data.get("farm", {}).get("crops", {})
-    logger.info(f"[DEBUG] Plots encontrados: {len(plots)}")
+    crops = analyze_farm(data).crops
+    debug_enabled = logger.isEnabledFor(logging.DEBUG)
+    if debug_enabled:
+        logger.debug("Plots encontrados: %d", crops.total)
     status_messages = []
     
-    if not plots:
-        logger.info("[DEBUG] No hay plots en la respuesta")
+    if not crops.total:
+        logger.debug("No hay plots en la respuesta")
         return ["No se encontraron parcelas plantadas activas."]
     
-    crops_found = False
+    if not crops.ids:
+        logger.debug("No se encontraron cultivos válidos")
+        return ["No hay cultivos plantados actualmente."]
     
-    for plot_id, plot_data in plots.items():
-        crop_data = plot_data.get("crop", {})
-        logger.info(f"[DEBUG] Procesando parcela {plot_id}: {json.dumps(crop_data)}")
-        
-        if not crop_data or not crop_data.get("name"):
-            logger.info(f"[DEBUG] Parcela {plot_id} sin cultivo")
+    for plot_id, crop_name, ready_at_ms in zip(crops.ids, crops.names, crops.ready_at):
+        if ready_at_ms is None:
             continue
-        
-        crop_name = crop_data.get("name")
-        ready_at_ms = calculate_crop_ready_time(crop_data)
-        crops_found = True  # Si llegamos aquí, encontramos al menos un cultivo
-        
-        if ready_at_ms is not None:
-            # Si el cultivo ya está listo, mostrar desde cuándo está listo
-            logger.info(f"[DEBUG] Parcela {plot_id} - Crop: {crop_name} | plantedAt: {crop_data.get('plantedAt')} | boostedTime: {crop_data.get('boostedTime')} | base_ms: {CROP_BASE_TIMES_MS.get(crop_name)} | ready_at: {ready_at_ms} | now: {current_time_ms}")
-
-            if ready_at_ms <= current_time_ms:
-                since_str = get_time_since_ms(ready_at_ms, current_time_ms)
-                status_messages.append(
-                    f"**{crop_name}** (Parcela #{plot_id}): **¡LISTO!** — listo desde: {since_str}"
-                )
-            else:
-                time_remaining_str = get_time_remaining_ms(current_time_ms, ready_at_ms)
-                status_messages.append(
-                    f"**{crop_name}** (Parcela #{plot_id}): **{time_remaining_str}**"
-                )
-    
-    if not crops_found:
-        logger.info("[DEBUG] No se encontraron cultivos válidos")
-        return ["No hay cultivos plantados actualmente."]
+        # Si el cultivo ya está listo, mostrar desde cuándo está listo
+        if debug_enabled:
+            log_event(logging.DEBUG, "crop_status", plot=plot_id, crop=crop_name,
+                      ready_at=ready_at_ms, now=current_time_ms)
+
+        if ready_at_ms <= current_time_ms:
+            since_str = get_time_since_ms(ready_at_ms, current_time_ms)
+            status_messages.append(
+                f"**{crop_name}** (Parcela #{plot_id}): **¡LISTO!** — listo desde: {since_str}"
+            )
+        else:
+            time_remaining_str = get_time_remaining_ms(current_time_ms, ready_at_ms)
+            status_messages.append(
+                f"**{crop_name}** (Parcela #{plot_id}): **{time_remaining_str}**"
+            )
     
     return status_messages
 
-def process_stones_alerts(data: Dict, user_info: Dict, current_time_ms: float) -> List[str]:
+def process_stones_alerts(data: Dict, user_info: Dict, current_time_ms: float,
+                          fetched_at_ms: Optional[float] = None) -> List[str]:
     """Procesa las alertas de piedras listas para minar."""
-    stones = data.get("farm", {}).get("stones", {})
     last_status = user_info.get('last_notified_status', {})
-    stone_alert_key = "stones_ready"
     alerts = []
     
-    ready_stones_count = 0
-    logger.info(f"[DEBUG] Verificando {len(stones)} piedras...")
-    
-    if stones:
-        for stone_id, stone_data in stones.items():
-            stone_resource_data = stone_data.get("stone", {})
-            mined_at_ms = stone_resource_data.get("minedAt")
-            
-            if mined_at_ms:
-                ready_at_ms = mined_at_ms + STONE_RESPAWN_BASE_MS
-                
-                if ready_at_ms <= current_time_ms:
-                    ready_stones_count += 1
-                    logger.info(f"[DEBUG] Piedra #{stone_id} lista para minar!")
-                else:
-                    time_left = ready_at_ms - current_time_ms
-                    minutes_left = time_left / (1000 * 60)
-                    logger.info(f"[DEBUG] Piedra #{stone_id} estará lista en {minutes_left:.1f} minutos")
+    ready_stones_count = advance_ready_watermark(analyze_farm(data).stones, last_status, "stones",
+                                  current_time_ms, fetched_at_ms)
     
-    if ready_stones_count > 0:
-        if not last_status.get(stone_alert_key, False):
-            if ready_stones_count == 1:
-                alerts.append("🪨 ¡Mina Lista! Una piedra está lista para ser minada.")
-            else:
-                alerts.append(f"🪨 ¡Mina Lista! **{ready_stones_count}** piedras están listas para ser minadas.")
-            last_status[stone_alert_key] = True
-    else:
-        last_status[stone_alert_key] = False
+    if ready_stones_count == 1:
+        alerts.append("🪨 ¡Mina Lista! Una piedra está lista para ser minada.")
+    elif ready_stones_count > 1:
+        alerts.append(f"🪨 ¡Mina Lista! **{ready_stones_count}** piedras están listas para ser minadas.")
     
     return alerts
 
-def process_trees_alerts(data: Dict, user_info: Dict, current_time_ms: float) -> List[str]:
+def process_trees_alerts(data: Dict, user_info: Dict, current_time_ms: float,
+                         fetched_at_ms: Optional[float] = None) -> List[str]:
     """Procesa las alertas de árboles listos para talar."""
-    trees = data.get("farm", {}).get("trees", {})
     last_status = user_info.get('last_notified_status', {})
-    tree_alert_key = "trees_ready"
     alerts = []
     
-    ready_trees_count = 0
-    logger.info(f"[DEBUG] Verificando {len(trees)} árboles...")
-    
-    if trees:
-        for tree_id, tree_data in trees.items():
-            wood_resource_data = tree_data.get("wood", {})
-            chopped_at_ms = wood_resource_data.get("choppedAt")
-            
-            if chopped_at_ms:
-                ready_at_ms = chopped_at_ms + TREE_GROWTH_BASE_MS
-                
-                if ready_at_ms <= current_time_ms:
-                    ready_trees_count += 1
-                    logger.info(f"[DEBUG] Árbol #{tree_id} listo para talar!")
-                else:
-                    time_left = ready_at_ms - current_time_ms
-                    minutes_left = time_left / (1000 * 60)
-                    logger.info(f"[DEBUG] Árbol #{tree_id} estará listo en {minutes_left:.1f} minutos")
+    ready_trees_count = advance_ready_watermark(analyze_farm(data).trees, last_status, "trees",
+                                 current_time_ms, fetched_at_ms)
     
-    if ready_trees_count > 0:
-        if not last_status.get(tree_alert_key, False):
-            if ready_trees_count == 1:
-                alerts.append("🌲 ¡Tala Lista! Un árbol está listo para ser talado.")
-            else:
-                alerts.append(f"🌲 ¡Tala Lista! **{ready_trees_count}** árboles están listos para ser talados.")
-            last_status[tree_alert_key] = True
-    else:
-        last_status[tree_alert_key] = False
+    if ready_trees_count == 1:
+        alerts.append("🌲 ¡Tala Lista! Un árbol está listo para ser talado.")
+    elif ready_trees_count > 1:
+        alerts.append(f"🌲 ¡Tala Lista! **{ready_trees_count}** árboles están listos para ser talados.")
     
     return alerts
 
@@ -521,18 +1934,8 @@ def process_floating_island_alerts(data: Dict, user_info: Dict, current_time_ms:
     """Procesa alertas para eventos de Floating Island."""
     alerts = []
     last_status = user_info.get('last_notified_status', {})
-    floating_island = data.get("farm", {}).get("floatingIsland", {}).get("schedule", [])
 
-    if not floating_island:
-        return alerts
-
-    for event in floating_island:
-        start_time_ms = event.get("startAt")
-        end_time_ms = event.get("endAt")
-        
-        if not start_time_ms or not end_time_ms:
-            continue
-            
+    for start_time_ms, end_time_ms in analyze_farm(data).island_events:
         # Generar alertas 5 minutos antes del inicio
         pre_start_key = f"floating_island_pre_start_{start_time_ms}"
         if (start_time_ms - current_time_ms <= PRE_EVENT_ALERT_MS and 
@@ -555,36 +1958,51 @@ def process_floating_island_alerts(data: Dict, user_info: Dict, current_time_ms:
 
     return alerts
 
-def process_crops_alerts(data: Dict, user_info: Dict, current_time_ms: float) -> List[str]:
+def prune_notification_flags(user_info: Dict, data: Dict, current_time_ms: float) -> List[str]:
+    """Elimina de last_notified_status las banderas que ya no pueden volver a usarse.
+
+    - floating_island_pre_start_<ms> / floating_island_pre_end_<ms> cuyo
+      instante ya pasó (la pre-alerta solo se dispara antes de ese instante)
+    - beehive_<id>_finished de colmenas que ya no existen en la granja
+
+    Así el estado por chat no crece sin límite. Retorna las claves borradas.
+    """
+    last_status = user_info.get('last_notified_status')
+    if not last_status:
+        return []
+
+    beehive_ids = analyze_farm(data).beehive_ids
+
+    expired = []
+    for key in last_status:
+        if key.startswith(("floating_island_pre_start_", "floating_island_pre_end_")):
+            try:
+                event_ms = float(key.rsplit('_', 1)[-1])
+            except ValueError:
+                continue
+            if event_ms <= current_time_ms:
+                expired.append(key)
+        elif beehive_ids is not None and key.startswith('beehive_') and key.endswith('_finished'):
+            if key[len('beehive_'):-len('_finished')] not in beehive_ids:
+                expired.append(key)
+
+    for key in expired:
+        del last_status[key]
+    return expired
+
+def process_crops_alerts(data: Dict, user_info: Dict, current_time_ms: float,
+                         fetched_at_ms: Optional[float] = None) -> List[str]:
     """Procesa alertas de cultivos listos para cosechar."""
-    plots = data.get("farm", {}).get("crops", {})
     last_status = user_info.get('last_notified_status', {})
-    crop_alert_key = "crops_ready"
     alerts = []
     
-    ready_crops_count = 0
-    
-    if plots and isinstance(plots, dict):
-        for plot_id, plot_data in plots.items():
-            crop_data = plot_data.get("crop", {})
-            
-            if not crop_data or not crop_data.get("name"):
-                continue
-            
-            ready_at_ms = calculate_crop_ready_time(crop_data)
-            
-            if ready_at_ms and ready_at_ms <= current_time_ms:
-                ready_crops_count += 1
+    ready_crops_count = advance_ready_watermark(analyze_farm(data).crops, last_status, "crops",
+                                 current_time_ms, fetched_at_ms)
     
-    if ready_crops_count > 0:
-        if not last_status.get(crop_alert_key, False):
-            if ready_crops_count == 1:
-                alerts.append("🥕 ¡Cosecha Lista! Un cultivo está listo para ser cosechado.")
-            else:
-                alerts.append(f"🥕 ¡Cosecha Lista! **{ready_crops_count}** cultivos están listos.")
-            last_status[crop_alert_key] = True
-    else:
-        last_status[crop_alert_key] = False
+    if ready_crops_count == 1:
+        alerts.append("🥕 ¡Cosecha Lista! Un cultivo está listo para ser cosechado.")
+    elif ready_crops_count > 1:
+        alerts.append(f"🥕 ¡Cosecha Lista! **{ready_crops_count}** cultivos están listos.")
     
     return alerts
 
@@ -606,94 +2024,592 @@ Comandos de recursos:
 - /trees: Estado de árboles
 - /stones: Estado de piedras
 
-Cada comando tiene su propia función handle_X_command para mantener
-el código organizado y facilitar el mantenimiento.
+Cada comando tiene su propia función handle_X_command, registrada en
+COMMAND_ROUTES con register_command. dispatch_update busca el comando en
+el diccionario (ignora mayúsculas y el sufijo `@bot`) y lo ejecuta a través
+de los middlewares (timing, rate limiting, auth).
 """
 
-def handle_telegram_commands(user_data: Dict) -> Dict:
-    """Obtiene y procesa nuevos mensajes de Telegram."""
-    global LAST_UPDATE_ID
-    
-    telegram_url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/getUpdates"
+def poll_telegram_updates(poll_timeout: int = 25) -> Optional[List[Dict]]:
+    """Hace long-polling de getUpdates y avanza LAST_UPDATE_ID.
+
+    `poll_timeout` limita cuánto espera Telegram antes de responder vacío.
+    Retorna None si la consulta falló (también con 409, cuando otra instancia
+    lee getUpdates), para que quien llama espere antes de reintentar.
+    """
+    telegram_url = telegram_api_url("getUpdates")
     
-    params = {'timeout': 25}
+    params = {'timeout': poll_timeout}
     if LAST_UPDATE_ID is not None:
         params['offset'] = LAST_UPDATE_ID + 1
 
     try:
-        response = requests.get(telegram_url, params=params, timeout=30)
+        response = TELEGRAM_SESSION.get(
+            telegram_url, params=params,
+            timeout=(HTTP_CONNECT_TIMEOUT_SECONDS, poll_timeout + 5),
+        )
+        if response.status_code == 409:
+            logger.error("⚠️ Telegram respondió 409: otra instancia del bot está leyendo getUpdates")
+            return None
         response.raise_for_status()
         updates = response.json().get('result', [])
     except requests.exceptions.RequestException as e:
-        logger.error(f"Error al obtener actualizaciones de Telegram: {e}")
-        return user_data
+        # El mensaje de requests incluye la URL, y con ella el token del bot
+        logger.error(f"Error al obtener actualizaciones de Telegram: {str(e).replace(TELEGRAM_BOT_TOKEN, '***')}")
+        return None
+
+    if updates:
+        note_received_updates(updates)
+        checkpoint_update_offset()
+    return updates
+
+# update_ids recibidos que todavía no despachó ningún worker
+PENDING_UPDATE_IDS: Set[int] = set()
+PENDING_UPDATE_LOCK = threading.Lock()
+
+def note_received_updates(updates: List[Dict]) -> None:
+    """Avanza LAST_UPDATE_ID y anota los updates como pendientes de despachar."""
+    global LAST_UPDATE_ID
+    with PENDING_UPDATE_LOCK:
+        for update in updates:
+            update_id = update.get('update_id')
+            if not isinstance(update_id, int):
+                continue
+            PENDING_UPDATE_IDS.add(update_id)
+            if LAST_UPDATE_ID is None or update_id > LAST_UPDATE_ID:
+                LAST_UPDATE_ID = update_id
 
-    if not updates:
-        return user_data
+def release_update(update: Dict) -> None:
+    """Quita un update de los pendientes (ya despachado o descartado a propósito)."""
+    with PENDING_UPDATE_LOCK:
+        PENDING_UPDATE_IDS.discard(update.get('update_id'))
 
-    # Procesar todas las actualizaciones
+def checkpoint_update_offset() -> None:
+    """Guarda en el estado (`_last_update_id`) desde dónde reanudar tras reiniciar.
+
+    Es el último update_id que, junto con todos los anteriores, ya se
+    despachó: los que siguen en una cola (p. ej. recibidos mientras el bot se
+    apaga) se vuelven a pedir a Telegram en el próximo arranque.
+    """
+    with PENDING_UPDATE_LOCK:
+        offset = min(PENDING_UPDATE_IDS) - 1 if PENDING_UPDATE_IDS else LAST_UPDATE_ID
+    if offset is None:
+        return
+    with USER_STATE.lock:
+        if USER_STATE.data.get('_last_update_id') != offset:
+            USER_STATE.data['_last_update_id'] = offset
+            USER_STATE.mark_dirty('_last_update_id')
+
+def collect_update_backlog(max_batches: int = 50) -> List[Dict]:
+    """Descarga de golpe los updates acumulados mientras el bot estuvo caído."""
+    backlog: List[Dict] = []
+    for _ in range(max_batches):
+        updates = poll_telegram_updates(poll_timeout=0)
+        if not updates:
+            break
+        backlog.extend(updates)
+    return backlog
+
+def dedupe_updates(updates: List[Dict]) -> List[Dict]:
+    """Deja un solo update por (chat, comando), el más reciente, en orden de llegada.
+
+    Tras un reinicio, diez `/crops` seguidos del mismo chat se responden una vez.
+    """
+    latest: Dict[Tuple[str, str], Dict] = {}
+    passthrough = []
     for update in updates:
-        update_id = update['update_id']
-        
         message = update.get('message')
         if not message:
-            # Actualizar LAST_UPDATE_ID incluso si no hay mensaje
-            if LAST_UPDATE_ID is None or update_id > LAST_UPDATE_ID:
-                LAST_UPDATE_ID = update_id
             continue
-        
-        chat_id = str(message['chat']['id'])
-        text = message.get('text', '').strip()
-        
-        logger.info(f"📬 Mensaje de {chat_id}: {text}")
-        
-        # Procesar comandos
-        if text.lower().startswith('/setfarm '):
-            handle_setfarm_command(chat_id, text, user_data)
-        
-        elif text.lower() == '/start':
-            handle_start_command(chat_id)
-        
-        elif text.lower() == '/getfarm':
-            handle_getfarm_command(chat_id, user_data)
-        
-        elif text.lower() == '/beehive':
-            handle_beehive_command(chat_id, user_data)
-        
-        elif text.lower() == '/crops':
-            handle_crops_command(chat_id, user_data)
-        
-        elif text.lower() == '/help':
-            handle_help_command(chat_id)
-            
-        elif text.lower() == '/trees':
-            logger.info("Comando /trees detectado")
-            handle_trees_command(chat_id, user_data)
-            
-        elif text.lower() == '/stones':
-            logger.info("Comando /stones detectado")
-            handle_stones_command(chat_id, user_data)
-            
-        elif text.lower() == '/globe':
-            logger.info("Comando /globe detectado")
-            handle_globe_command(chat_id, user_data)
-        
-        # Actualizar LAST_UPDATE_ID después de procesar cada mensaje
-        if LAST_UPDATE_ID is None or update_id > LAST_UPDATE_ID:
-            LAST_UPDATE_ID = update_id
+        text = (message.get('text') or '').strip().lower()
+        if not text.startswith('/'):
+            passthrough.append(update)
+            continue
+        latest[(_update_chat_id(update), text)] = update
+    return sorted(passthrough + list(latest.values()), key=lambda u: u['update_id'])
+
+class CommandContext:
+    """Datos de un comando ya parseado que reciben handlers y middlewares."""
+    __slots__ = ('chat_id', 'command', 'args', 'text', 'user_data')
+
+    def __init__(self, chat_id: str, command: str, args: List[str], text: str, user_data: Dict):
+        self.chat_id = chat_id
+        self.command = command
+        self.args = args
+        self.text = text
+        self.user_data = user_data
+
+CommandHandler = Callable[[CommandContext], None]
+CommandMiddleware = Callable[[CommandContext, CommandHandler], None]
+
+class CommandRoute:
+    """Entrada del router: handler final más sus middlewares propios."""
+    __slots__ = ('name', 'handler', 'middleware', 'max_args', 'chain')
+
+    def __init__(self, name: str, handler: CommandHandler, middleware: List[CommandMiddleware],
+                 max_args: Optional[int]):
+        self.name = name
+        self.handler = handler
+        self.middleware = middleware
+        self.max_args = max_args
+        self.chain: Optional[CommandHandler] = None
+
+COMMAND_ROUTES: Dict[str, CommandRoute] = {}
+COMMAND_MIDDLEWARE: List[CommandMiddleware] = []   # Se aplican a todos los comandos, en orden
+
+def register_command(name: str, handler: CommandHandler, middleware: Iterable[CommandMiddleware] = (),
+                     max_args: Optional[int] = 0) -> None:
+    """Registra `/name` en el router.
+
+    `max_args` es el número de argumentos que acepta (None: sin límite, el
+    handler los valida); un mensaje con más argumentos no coincide con el
+    comando, como hacía la cadena de ifs.
+    """
+    name = name.lstrip('/').lower()
+    COMMAND_ROUTES[name] = CommandRoute(name, handler, list(middleware), max_args)
+
+def use_command_middleware(middleware: CommandMiddleware) -> None:
+    """Añade un middleware global (timing, rate limiting, auth...)."""
+    COMMAND_MIDDLEWARE.append(middleware)
+    for route in COMMAND_ROUTES.values():
+        route.chain = None
+
+def _build_chain(route: CommandRoute) -> CommandHandler:
+    """Compone middlewares globales + propios alrededor del handler."""
+    chain = route.handler
+    for middleware in reversed(COMMAND_MIDDLEWARE + route.middleware):
+        chain = (lambda mw, nxt: lambda ctx: mw(ctx, nxt))(middleware, chain)
+    return chain
+
+def parse_command(text: str) -> Optional[Tuple[str, List[str]]]:
+    """Separa `/Comando@bot arg1 arg2` en ('comando', ['arg1', 'arg2']).
+
+    Devuelve None si el texto no es un comando o va dirigido a otro bot.
+    """
+    if not text.startswith('/'):
+        return None
+    parts = text.split()
+    command, _, bot_name = parts[0][1:].partition('@')
+    if bot_name and TELEGRAM_BOT_USERNAME and bot_name.lower() != TELEGRAM_BOT_USERNAME:
+        return None
+    return command.lower(), parts[1:]
 
-    return user_data
+def dispatch_update(update: Dict, user_data: Dict) -> None:
+    """Ejecuta el comando contenido en un update de Telegram."""
+    message = update.get('message')
+    if not message:
+        return
+    
+    chat_id = str(message['chat']['id'])
+    text = message.get('text', '').strip()
+    
+    logger.info(f"📬 Mensaje de {chat_id}: {text}")
+    
+    parsed = parse_command(text)
+    if parsed is None:
+        return
+    command, args = parsed
+    route = COMMAND_ROUTES.get(command)
+    if route is None or (route.max_args is not None and len(args) > route.max_args):
+        return
+    if route.chain is None:
+        route.chain = _build_chain(route)
+    route.chain(CommandContext(chat_id, command, args, text, user_data))
+
+def timing_middleware(ctx: CommandContext, call_next: CommandHandler) -> None:
+    """Mide cuánto tarda cada comando (sfl_command_duration_seconds) y cuenta sus errores."""
+    started = time.monotonic()
+    failed = True
+    try:
+        call_next(ctx)
+        failed = False
+    finally:
+        elapsed_ms = (time.monotonic() - started) * 1000
+        METRICS.observe("sfl_command_duration_seconds", elapsed_ms / 1000, command=ctx.command)
+        if failed:
+            METRICS.inc("sfl_command_errors_total", command=ctx.command)
+        log_event(logging.DEBUG, "command", command=ctx.command, chat=ctx.chat_id, ms=round(elapsed_ms, 1))
+
+def require_admin(ctx: CommandContext, call_next: CommandHandler) -> None:
+    """Solo deja pasar a los chats de TELEGRAM_ADMIN_CHAT_IDS."""
+    if ctx.chat_id not in TELEGRAM_ADMIN_CHAT_IDS:
+        logger.warning(f"⛔ Comando /{ctx.command} denegado para {ctx.chat_id}")
+        return
+    call_next(ctx)
+
+def rate_limit_middleware(ctx: CommandContext, call_next: CommandHandler) -> None:
+    """Limita por chat y por granja los comandos que consultan la API.
+
+    Si la granja está fresca en caché el comando no gasta cuota y pasa sin
+    límite. Si no, consume un token del chat y otro de la granja; cuando falta
+    alguno se responde con el último snapshot en caché o, si no lo hay, con
+    cuánto esperar.
+    """
+    farm_id = ctx.user_data.get(ctx.chat_id, {}).get('farm_id')
+    if not farm_id:
+        call_next(ctx)
+        return
+    cached = FARM_CACHE.peek(farm_id)   # El handler hace su propio lookup: aquí no cuenta como consulta
+    if cached is not None and cached[1] <= FARM_CACHE_TTL_SECONDS:
+        call_next(ctx)
+        return
+
+    wait = max(COMMAND_CHAT_LIMITER.wait_time(ctx.chat_id), COMMAND_FARM_LIMITER.wait_time(farm_id))
+    if wait <= 0:
+        COMMAND_CHAT_LIMITER.consume(ctx.chat_id)
+        COMMAND_FARM_LIMITER.consume(farm_id)
+        call_next(ctx)
+        return
+
+    COMMAND_CHAT_LIMITER.record_throttled(ctx.chat_id)
+    COMMAND_FARM_LIMITER.record_throttled(farm_id)
+    log_event(logging.INFO, "command_throttled", command=ctx.command, chat=ctx.chat_id, farm=farm_id, wait=round(wait))
+    if cached is None:
+        send_telegram_message(ctx.chat_id, f"⏳ Demasiadas consultas. Inténtalo de nuevo en {int(wait) + 1} s.")
+        return
+    COMMAND_SCOPE.cache_only = True
+    try:
+        call_next(ctx)
+    finally:
+        COMMAND_SCOPE.cache_only = False
+    send_telegram_message(
+        ctx.chat_id,
+        f"⏳ Datos de hace {int(cached[1] // 60)} min. Para datos nuevos, inténtalo en {int(wait) + 1} s."
+    )
+
+def _update_chat_id(update: Dict) -> str:
+    message = update.get('message') or {}
+    return str(message.get('chat', {}).get('id', ''))
+
+def route_update(update: Dict, command_queues: List["queue.Queue[Dict]"]) -> None:
+    """Encola un update en la cola del worker que atiende a su chat."""
+    chat_id = _update_chat_id(update)
+    command_queues[hash(chat_id) % len(command_queues)].put(update)
 
-def handle_setfarm_command(chat_id: str, text: str, user_data: Dict) -> None:
+def run_update_intake(command_queues: List["queue.Queue[Dict]"], stop_event: threading.Event) -> None:
+    """Recibe updates de Telegram y los reparte entre las colas de los workers.
+
+    Todos los mensajes de un mismo chat van a la misma cola, así que se
+    atienden en orden (p. ej. `/setfarm` antes que el `/crops` siguiente).
+    Al arrancar, el backlog pendiente se procesa en bloque y sin repetidos.
+    """
+    try:
+        backlog = collect_update_backlog()
+        if backlog:
+            pending = dedupe_updates(backlog)
+            logger.warning(f"📥 Backlog de {len(backlog)} updates; {len(pending)} tras quitar repetidos")
+            kept = {update['update_id'] for update in pending}
+            for update in backlog:
+                if update['update_id'] not in kept:
+                    release_update(update)
+            for update in pending:
+                route_update(update, command_queues)
+    except Exception as e:
+        logger.exception(f"🚨 Error procesando el backlog de updates: {e}")
+
+    failures = 0
+    while not stop_event.is_set():
+        try:
+            updates = poll_telegram_updates()
+            if updates is None:
+                failures += 1
+            # Si ya se está apagando no se encolan: quedan pendientes y se piden de nuevo al arrancar
+            elif not stop_event.is_set():
+                failures = 0
+                for update in updates:
+                    route_update(update, command_queues)
+        except Exception as e:
+            logger.exception(f"🚨 Error en la recepción de updates: {e}")
+            failures += 1
+        if failures:
+            # Backoff exponencial: sin él, un Telegram caído se consulta en bucle
+            stop_event.wait(min(TELEGRAM_POLL_BACKOFF_MAX_SECONDS, LOOP_SLEEP_SECONDS * 2 ** min(failures - 1, 4)))
+
+def run_command_worker(command_queue: "queue.Queue[Dict]", user_data: Dict, stop_event: threading.Event) -> None:
+    """Atiende los comandos de una cola hasta que se pida parar.
+
+    Al parar termina antes los comandos ya encolados, salvo que otra
+    instancia tenga el lease. El offset guardado solo avanza tras despachar
+    cada update (`checkpoint_update_offset`).
+    """
+    while True:
+        try:
+            update = command_queue.get(timeout=1)
+        except queue.Empty:
+            if stop_event.is_set():
+                return
+            continue
+        if USER_STATE.fenced:
+            command_queue.task_done()
+            continue
+        try:
+            dispatch_update(update, user_data)
+        except Exception as e:
+            logger.exception(f"🚨 Error procesando comando: {e}")
+        finally:
+            release_update(update)
+            checkpoint_update_offset()
+            command_queue.task_done()
+
+# Colas de los workers de comandos; vacía mientras esta instancia no atiende comandos
+COMMAND_QUEUES: List["queue.Queue[Dict]"] = []
+
+class BotHealth:
+    """Estado del proceso para /healthz y /readyz.
+
+    `phase` la actualiza main_loop (starting, standby, active, stopping) y el
+    monitor marca `monitor_beat` en cada vuelta y tras cada granja procesada.
+    El proceso está vivo salvo que el monitor lleve más de
+    HEALTH_MAX_SWEEP_LAG_SECONDS sin avanzar: un barrido largo (muchas
+    granjas con poca cuota de API) sigue vivo mientras procese granjas. Está
+    listo si además está activo y ninguna granja lleva más de ese tiempo
+    vencida sin procesar.
+    """
+
+    def __init__(self):
+        self.phase = "starting"
+        self.runs_monitor = False
+        self.monitor_beat: Optional[float] = None
+
+    def check(self) -> Tuple[bool, bool, Dict]:
+        """Retorna (vivo, listo, detalle)."""
+        now = time.time()
+        detail: Dict = {"phase": self.phase, "role": CLUSTER_ROLE}
+        live = True
+        overdue = 0.0
+        if self.runs_monitor and self.monitor_beat is not None:
+            beat_age = now - self.monitor_beat
+            overdue = FARM_SCHEDULER.overdue_seconds(now)
+            live = beat_age <= HEALTH_MAX_SWEEP_LAG_SECONDS + LOOP_SLEEP_SECONDS
+            detail.update(monitor_beat_age_seconds=round(beat_age, 1), overdue_seconds=round(overdue, 1))
+        ready = live and self.phase == "active" and overdue <= HEALTH_MAX_SWEEP_LAG_SECONDS
+        detail["status"] = "ok" if ready else ("not_ready" if live else "stalled")
+        return live, ready, detail
+
+BOT_HEALTH = BotHealth()
+
+def collect_runtime_metrics() -> Iterator[MetricSample]:
+    """Métricas que ya cuentan otros componentes, leídas en cada GET /metrics."""
+    now = time.time()
+    yield ("sfl_up", "gauge", "1 si esta instancia atiende el bot (0 en standby)", {},
+           1.0 if BOT_HEALTH.phase == "active" else 0.0)
+    yield ("sfl_farm_check_interval_seconds", "gauge", "Intervalo objetivo de refresco de granjas", {},
+           FARM_CHECK_INTERVAL_SECONDS)
+    yield ("sfl_scheduler_farms", "gauge", "Granjas programadas en el monitor", {}, len(FARM_SCHEDULER))
+    yield ("sfl_scheduler_overdue_seconds", "gauge", "Retraso de la granja vencida más antigua sin procesar", {},
+           FARM_SCHEDULER.overdue_seconds(now))
+    if BOT_HEALTH.monitor_beat is not None:
+        yield ("sfl_monitor_beat_age_seconds", "gauge", "Segundos desde el último avance del monitor", {},
+               now - BOT_HEALTH.monitor_beat)
+    yield ("sfl_command_queue_depth", "gauge", "Updates esperando en las colas de comandos", {},
+           sum(command_queue.qsize() for command_queue in COMMAND_QUEUES))
+
+    yield ("sfl_telegram_messages_sent_total", "counter", "Mensajes entregados a Telegram", {}, TELEGRAM_OUTBOX.sent)
+    yield ("sfl_telegram_send_failures_total", "counter", "Mensajes descartados tras fallar el envío", {},
+           TELEGRAM_OUTBOX.failed)
+    yield ("sfl_telegram_messages_coalesced_total", "counter", "Mensajes combinados con otro del mismo chat", {},
+           TELEGRAM_OUTBOX.coalesced)
+    yield ("sfl_telegram_outbox_pending", "gauge", "Mensajes pendientes en la cola de salida", {},
+           TELEGRAM_OUTBOX.pending_count())
+
+    cache = FARM_CACHE.stats()
+    yield ("sfl_farm_cache_entries", "gauge", "Snapshots de granja en caché", {}, cache["entries"])
+    yield ("sfl_farm_cache_bytes", "gauge", "Tamaño aproximado de la caché de snapshots", {}, cache["bytes"])
+    yield ("sfl_farm_cache_hits_total", "counter", "Consultas servidas desde la caché", {}, cache["hits"])
+    yield ("sfl_farm_cache_misses_total", "counter", "Consultas sin snapshot en caché", {}, cache["misses"])
+    history = FARM_INDEX_HISTORY.stats()
+    yield ("sfl_farm_index_builds_total", "counter", "Índices de temporizadores por resultado", {"result": "unchanged"},
+           history["unchanged"])
+    yield ("sfl_farm_index_builds_total", "counter", "Índices de temporizadores por resultado", {"result": "rebuilt"},
+           history["rebuilt"])
+    yield ("sfl_farms_parked", "gauge", "Granjas aparcadas por el cortacircuitos", {}, FARM_BREAKER.open_count())
+    yield ("sfl_api_rate_per_second", "gauge", "Tasa actual permitida hacia la API de Sunflower Land", {},
+           SFL_API_LIMITER.rate)
+    for scope, limiter in (("chat", COMMAND_CHAT_LIMITER), ("farm", COMMAND_FARM_LIMITER)):
+        yield ("sfl_command_throttled_total", "counter", "Comandos limitados por exceso de consultas", {"scope": scope},
+               limiter.throttled_total)
+
+    state = USER_STATE.stats()
+    yield ("sfl_state_chats", "gauge", "Chats registrados", {}, state["chats"])
+    yield ("sfl_state_flags", "gauge", "Banderas de notificación guardadas", {}, state["flags"])
+    yield ("sfl_state_dirty_entries", "gauge", "Entradas del estado pendientes de escribir", {}, state["dirty"])
+    yield ("sfl_state_file_bytes", "gauge", "Tamaño en disco del estado", {"backend": USER_STATE.backend.name},
+           USER_STATE.backend.size_bytes())
+
+METRICS.add_collector(collect_runtime_metrics)
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    """Servidor HTTP del bot en PORT (METRICS_PORT en los workers del clúster).
+
+    - POST WEBHOOK_PATH (modo webhook): recibe los updates de Telegram y los
+      pasa a `route_update`; responde 200 en cuanto están encolados y 503
+      mientras esta instancia no atiende comandos (Telegram reintenta). Sin la
+      cabecera de WEBHOOK_SECRET_TOKEN responde 403.
+    - GET /metrics: métricas en formato Prometheus (METRICS_ENABLED).
+    - GET /healthz y /readyz: vivo / listo según BOT_HEALTH (200 o 503).
+    """
+
+    server_version = "SFLBotWebhook/1.0"
+    recent_update_ids: "OrderedDict[int, None]" = OrderedDict()
+    recent_lock = threading.Lock()
+
+    def log_message(self, format, *args) -> None:
+        logger.debug("webhook %s", format % args)
+
+    def _reply(self, status: int, body: str = "", content_type: str = "text/plain; charset=utf-8") -> None:
+        payload = body.encode("utf-8")
+        self.send_response(status)
+        if payload:
+            self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        if payload:
+            self.wfile.write(payload)
+
+    def do_GET(self) -> None:
+        path = self.path.split("?", 1)[0]
+        if path == "/metrics" and METRICS_ENABLED:
+            self._reply(200, METRICS.render(), "text/plain; version=0.0.4; charset=utf-8")
+        elif path in ("/healthz", "/readyz"):
+            live, ready, detail = BOT_HEALTH.check()
+            ok = live if path == "/healthz" else ready
+            self._reply(200 if ok else 503, json.dumps(detail), "application/json")
+        else:
+            self._reply(404)
+
+    def _is_duplicate(self, update_id: Optional[int]) -> bool:
+        """Telegram reintenta los updates no confirmados; se ignoran los ya vistos."""
+        if update_id is None:
+            return False
+        with self.recent_lock:
+            if update_id in self.recent_update_ids:
+                return True
+            self.recent_update_ids[update_id] = None
+            while len(self.recent_update_ids) > 1000:
+                self.recent_update_ids.popitem(last=False)
+        return False
+
+    def do_POST(self) -> None:
+        if TELEGRAM_INTAKE_MODE != "webhook" or self.path != WEBHOOK_PATH:
+            self._reply(404)
+            return
+        if not COMMAND_QUEUES:
+            self._reply(503)
+            return
+        # Sin el secreto cualquiera podría enviar updates falsos con el chat.id de otro (o de un admin)
+        received_token = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not WEBHOOK_SECRET_TOKEN or not hmac.compare_digest(received_token.encode(), WEBHOOK_SECRET_TOKEN.encode()):
+            self._reply(403)
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            update = json.loads(self.rfile.read(length))
+        except (ValueError, json.JSONDecodeError):
+            self._reply(400)
+            return
+        if not isinstance(update, dict):
+            self._reply(400)
+            return
+
+        if not self._is_duplicate(update.get('update_id')):
+            note_received_updates([update])
+            route_update(update, COMMAND_QUEUES)
+        self._reply(200)
+
+def register_webhook() -> bool:
+    """Registra WEBHOOK_PUBLIC_URL en Telegram con setWebhook."""
+    payload = {'url': WEBHOOK_PUBLIC_URL.rstrip('/') + WEBHOOK_PATH, 'allowed_updates': json.dumps(["message"])}
+    if WEBHOOK_SECRET_TOKEN:
+        payload['secret_token'] = WEBHOOK_SECRET_TOKEN
+    try:
+        response = TELEGRAM_SESSION.post(
+            telegram_api_url("setWebhook"), data=payload,
+            timeout=(HTTP_CONNECT_TIMEOUT_SECONDS, TELEGRAM_READ_TIMEOUT_SECONDS),
+        )
+        response.raise_for_status()
+        logger.info(f"🔗 Webhook registrado en {payload['url']}")
+        return True
+    except requests.exceptions.RequestException as e:
+        logger.error(f"No se pudo registrar el webhook: {e}")
+        return False
+
+def start_http_server(port: int, allow_any_port: bool = False) -> Optional[ThreadingHTTPServer]:
+    """Levanta el servidor HTTP del bot en `port` (webhook, métricas y salud).
+
+    Con `allow_any_port`, si el puerto está ocupado (p. ej. varios workers en
+    la misma máquina) se usa uno libre asignado por el sistema. Retorna None
+    si no se pudo abrir ninguno.
+    """
+    try:
+        server = ThreadingHTTPServer((WEBHOOK_LISTEN_HOST, port), WebhookRequestHandler)
+    except OSError as e:
+        if allow_any_port and port != 0:
+            logger.warning(f"🌐 {WEBHOOK_LISTEN_HOST}:{port} ocupado ({e}); se usa un puerto libre")
+            return start_http_server(0)
+        logger.error(f"🌐 No se pudo abrir {WEBHOOK_LISTEN_HOST}:{port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="bot-http", daemon=True).start()
+    logger.info(f"🌐 HTTP escuchando en {WEBHOOK_LISTEN_HOST}:{server.server_address[1]}")
+    return server
+
+def stop_http_server(server: Optional[ThreadingHTTPServer]) -> None:
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+
+def run_webhook_server(command_queues: List["queue.Queue[Dict]"], stop_event: threading.Event) -> None:
+    """Alternativa a `run_update_intake`: los updates llegan por WEBHOOK_PATH en el servidor HTTP.
+
+    Las colas se publican en COMMAND_QUEUES (main_loop); aquí solo se registra el webhook.
+    """
+    logger.info(f"🌐 Webhook en {WEBHOOK_PATH}")
+    if WEBHOOK_PUBLIC_URL:
+        register_webhook()
+    stop_event.wait()
+
+class WebhookTestClient:
+    """Cliente local que imita a Telegram enviando updates al webhook.
+
+    Útil para probar el modo webhook sin exponer el bot a Internet:
+        WebhookTestClient("http://127.0.0.1:8080").send_text("/crops", chat_id=123)
+    """
+
+    def __init__(self, base_url: str, secret_token: str = WEBHOOK_SECRET_TOKEN):
+        self.url = base_url.rstrip('/') + WEBHOOK_PATH
+        self.secret_token = secret_token
+        self._next_update_id = int(time.time())
+
+    def send_update(self, update: Dict) -> int:
+        headers = {"Content-Type": "application/json"}
+        if self.secret_token:
+            headers["X-Telegram-Bot-Api-Secret-Token"] = self.secret_token
+        response = requests.post(self.url, data=json.dumps(update), headers=headers, timeout=5)
+        return response.status_code
+
+    def send_text(self, text: str, chat_id: int) -> int:
+        self._next_update_id += 1
+        update = {
+            'update_id': self._next_update_id,
+            'message': {
+                'message_id': self._next_update_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': text,
+            },
+        }
+        return self.send_update(update)
+
+def handle_setfarm_command(chat_id: str, args: List[str], user_data: Dict) -> None:
     """Maneja el comando /setfarm."""
-    parts = text.split()
-    if len(parts) == 2 and parts[1].isdigit():
-        farm_id = parts[1]
-        if chat_id not in user_data:
-            user_data[chat_id] = {}
-        user_data[chat_id]['farm_id'] = farm_id
-        user_data[chat_id]['last_notified_status'] = {}
-        save_user_data(user_data)
+    if len(args) == 1 and args[0].isdigit():
+        farm_id = args[0]
+        with USER_STATE.lock:
+            if chat_id not in user_data:
+                user_data[chat_id] = {}
+            user_data[chat_id]['farm_id'] = farm_id
+            user_data[chat_id]['last_notified_status'] = {}
+            USER_STATE.mark_dirty(chat_id)
         send_telegram_message(chat_id, f"✅ *ID de Granja registrado!*\nTu nuevo ID es: *{farm_id}*")
     else:
         send_telegram_message(chat_id, "❌ Formato incorrecto. Usa: `/setfarm [ID]` (ej: `/setfarm 23270`)")
@@ -722,15 +2638,19 @@ def handle_beehive_command(chat_id: str, user_data: Dict) -> None:
         send_telegram_message(chat_id, "❌ Configura tu ID primero con `/setfarm [ID]`")
         return
 
-    data = fetch_farm_data(farm_id)
+    data = get_farm_data(farm_id)
     if not data:
         send_telegram_message(chat_id, "❌ Error al obtener datos de la granja.")
         return
     
     current_time_ms = time.time() * 1000
-    user_info = user_data.get(chat_id, {})
-    
-    beehive_status_messages, _ = process_beehives(data, user_info, current_time_ms)
+    with USER_STATE.lock:
+        user_info = user_data.get(chat_id, {})
+        previous_status = dict(user_info.get('last_notified_status', {}))
+        beehive_status_messages, _ = process_beehives(data, user_info, current_time_ms)
+        changed_flags = diff_flags(previous_status, user_info.get('last_notified_status', {}))
+        if changed_flags:
+            USER_STATE.mark_dirty(chat_id, changed_flags)
 
     if beehive_status_messages:
         header = f"🐝 *Estado de Colmenas - Granja {farm_id}* 🐝\n\n"
@@ -738,8 +2658,6 @@ def handle_beehive_command(chat_id: str, user_data: Dict) -> None:
         send_telegram_message(chat_id, full_message)
     else:
         send_telegram_message(chat_id, "No se encontraron colmenas en esta granja.")
-    
-    save_user_data(user_data)
 
 def handle_crops_command(chat_id: str, user_data: Dict) -> None:
     """Maneja el comando /crops."""
@@ -748,7 +2666,7 @@ def handle_crops_command(chat_id: str, user_data: Dict) -> None:
         send_telegram_message(chat_id, "❌ Configura tu ID primero con `/setfarm [ID]`")
         return
 
-    data = fetch_farm_data(farm_id)
+    data = get_farm_data(farm_id)
     if not data:
         send_telegram_message(chat_id, "❌ Error al obtener datos de la granja.")
         return
@@ -770,33 +2688,28 @@ def handle_stones_command(chat_id: str, user_data: Dict) -> None:
         send_telegram_message(chat_id, "❌ Configura tu ID primero con `/setfarm [ID]`")
         return
 
-    data = fetch_farm_data(farm_id)
+    data = get_farm_data(farm_id)
     if not data:
         send_telegram_message(chat_id, "❌ Error al obtener datos de la granja.")
         return
     
     current_time_ms = time.time() * 1000
-    stones = data.get("farm", {}).get("stones", {})
-    logger.info(f"Piedras encontradas: {len(stones)}")
+    stones = analyze_farm(data).stones
+    logger.info(f"Piedras encontradas: {stones.total}")
     stone_messages = []
     
-    if not stones:
+    if not stones.total:
         logger.info("No se encontraron piedras en la respuesta de la API")
         send_telegram_message(chat_id, "No se encontraron piedras en esta granja.")
         return
     
-    for stone_id, stone_data in stones.items():
-        stone_resource = stone_data.get("stone", {})
-        mined_at_ms = stone_resource.get("minedAt")
-        
-        if mined_at_ms:
-            ready_at_ms = mined_at_ms + STONE_RESPAWN_BASE_MS
-            if ready_at_ms <= current_time_ms:
-                since_str = get_time_since_ms(ready_at_ms, current_time_ms)
-                stone_messages.append(f"🪨 Piedra #{stone_id}: **¡LISTA!** (desde hace {since_str})")
-            else:
-                time_remaining = get_time_remaining_ms(current_time_ms, ready_at_ms)
-                stone_messages.append(f"🪨 Piedra #{stone_id}: Lista en **{time_remaining}**")
+    for stone_id, ready_at_ms in zip(stones.ids, stones.ready_at):
+        if ready_at_ms <= current_time_ms:
+            since_str = get_time_since_ms(ready_at_ms, current_time_ms)
+            stone_messages.append(f"🪨 Piedra #{stone_id}: **¡LISTA!** (desde hace {since_str})")
+        else:
+            time_remaining = get_time_remaining_ms(current_time_ms, ready_at_ms)
+            stone_messages.append(f"🪨 Piedra #{stone_id}: Lista en **{time_remaining}**")
     
     if stone_messages:
         header = f"⛰️ *Estado de las Piedras - Granja {farm_id}* ⛰️\n\n"
@@ -816,33 +2729,28 @@ def handle_trees_command(chat_id: str, user_data: Dict) -> None:
         send_telegram_message(chat_id, "❌ Configura tu ID primero con `/setfarm [ID]`")
         return
 
-    data = fetch_farm_data(farm_id)
+    data = get_farm_data(farm_id)
     if not data:
         send_telegram_message(chat_id, "❌ Error al obtener datos de la granja.")
         return
     
     current_time_ms = time.time() * 1000
-    trees = data.get("farm", {}).get("trees", {})
-    logger.info(f"Árboles encontrados: {len(trees)}")
+    trees = analyze_farm(data).trees
+    logger.info(f"Árboles encontrados: {trees.total}")
     tree_messages = []
     
-    if not trees:
+    if not trees.total:
         logger.info("No se encontraron árboles en la respuesta de la API")
         send_telegram_message(chat_id, "No se encontraron árboles en esta granja.")
         return
     
-    for tree_id, tree_data in trees.items():
-        wood_data = tree_data.get("wood", {})
-        chopped_at_ms = wood_data.get("choppedAt")
-        
-        if chopped_at_ms:
-            ready_at_ms = chopped_at_ms + TREE_GROWTH_BASE_MS
-            if ready_at_ms <= current_time_ms:
-                since_str = get_time_since_ms(ready_at_ms, current_time_ms)
-                tree_messages.append(f"🌲 Árbol #{tree_id}: **¡LISTO!** (desde hace {since_str})")
-            else:
-                time_remaining = get_time_remaining_ms(current_time_ms, ready_at_ms)
-                tree_messages.append(f"🌲 Árbol #{tree_id}: Listo en **{time_remaining}**")
+    for tree_id, ready_at_ms in zip(trees.ids, trees.ready_at):
+        if ready_at_ms <= current_time_ms:
+            since_str = get_time_since_ms(ready_at_ms, current_time_ms)
+            tree_messages.append(f"🌲 Árbol #{tree_id}: **¡LISTO!** (desde hace {since_str})")
+        else:
+            time_remaining = get_time_remaining_ms(current_time_ms, ready_at_ms)
+            tree_messages.append(f"🌲 Árbol #{tree_id}: Listo en **{time_remaining}**")
     
     if tree_messages:
         header = f"🌳 *Estado de los Árboles - Granja {farm_id}* 🌳\n\n"
@@ -937,14 +2845,13 @@ def handle_globe_command(chat_id: str, user_data: Dict) -> None:
         send_telegram_message(chat_id, "❌ Configura tu ID primero con `/setfarm [ID]`")
         return
 
-    data = fetch_farm_data(farm_id)
+    data = get_farm_data(farm_id)
     if not data:
         send_telegram_message(chat_id, "❌ Error al obtener datos de la granja.")
         return
     
-    logger.info(f"[DEBUG] Datos recibidos de la API: {json.dumps(data, indent=2)}")
     current_time_ms = time.time() * 1000
-    floating_island = data.get("farm", {}).get("floatingIsland", {}).get("schedule", [])
+    floating_island = analyze_farm(data).island_schedule
 
     if not floating_island:
         send_telegram_message(chat_id, "No hay eventos de Floating Island programados.")
@@ -969,6 +2876,53 @@ def handle_help_command(chat_id: str) -> None:
     )
     send_telegram_message(chat_id, help_text)
 
+def handle_quota_command(chat_id: str) -> None:
+    """Maneja el comando /quota (solo admins): quién está gastando la cuota."""
+    lines = ["📊 *Consultas a la API por comando*\n", "*Chats* (permitidas / limitadas):"]
+    lines += [f"• `{key}`: {allowed} / {throttled}" for key, allowed, throttled in COMMAND_CHAT_LIMITER.stats()]
+    lines.append("\n*Granjas* (permitidas / limitadas):")
+    lines += [f"• `{key}`: {allowed} / {throttled}" for key, allowed, throttled in COMMAND_FARM_LIMITER.stats()]
+    send_telegram_message(chat_id, "\n".join(lines))
+
+def handle_profile_command(chat_id: str, args: List[str]) -> None:
+    """Maneja el comando /profile (solo admins).
+
+    `/profile` muestra el tiempo medio por fase del monitoreo y si hay una
+    captura en curso; `/profile cpu [N]` o `/profile mem [N]` capturan los
+    próximos N barridos (PROFILE_DEFAULT_SWEEPS si no se indica).
+    """
+    if not args:
+        lines = ["🔬 *Tiempo por fase* (media / llamadas)\n"]
+        totals = sorted(METRICS.totals("sfl_sweep_phase_seconds").items(), key=lambda item: item[1][0], reverse=True)
+        for labels, (total, count) in totals:
+            phase = dict(labels).get("phase", "?")
+            lines.append(f"• `{phase}`: {total / count * 1000:.1f} ms / {count}")
+        lines.append(f"\n{SWEEP_PROFILER.status()}")
+        send_telegram_message(chat_id, "\n".join(lines))
+        return
+    mode = args[0]
+    if mode not in ("cpu", "mem") or (len(args) == 2 and not args[1].isdigit()):
+        send_telegram_message(chat_id, "❌ Formato incorrecto. Usa: `/profile [cpu|mem] [barridos]`")
+        return
+    sweeps = int(args[1]) if len(args) == 2 else PROFILE_DEFAULT_SWEEPS
+    if SWEEP_PROFILER.request(mode, sweeps, chat_id):
+        send_telegram_message(chat_id, f"🔬 Capturando {mode} de los próximos {SWEEP_PROFILER.remaining} barridos...")
+    else:
+        send_telegram_message(chat_id, f"⏳ {SWEEP_PROFILER.status()}")
+
+register_command('start', lambda ctx: handle_start_command(ctx.chat_id))
+register_command('help', lambda ctx: handle_help_command(ctx.chat_id))
+register_command('setfarm', lambda ctx: handle_setfarm_command(ctx.chat_id, ctx.args, ctx.user_data), max_args=None)
+register_command('getfarm', lambda ctx: handle_getfarm_command(ctx.chat_id, ctx.user_data))
+register_command('beehive', lambda ctx: handle_beehive_command(ctx.chat_id, ctx.user_data), [rate_limit_middleware])
+register_command('crops', lambda ctx: handle_crops_command(ctx.chat_id, ctx.user_data), [rate_limit_middleware])
+register_command('trees', lambda ctx: handle_trees_command(ctx.chat_id, ctx.user_data), [rate_limit_middleware])
+register_command('stones', lambda ctx: handle_stones_command(ctx.chat_id, ctx.user_data), [rate_limit_middleware])
+register_command('globe', lambda ctx: handle_globe_command(ctx.chat_id, ctx.user_data), [rate_limit_middleware])
+register_command('quota', lambda ctx: handle_quota_command(ctx.chat_id), [require_admin])
+register_command('profile', lambda ctx: handle_profile_command(ctx.chat_id, ctx.args), [require_admin], max_args=2)
+use_command_middleware(timing_middleware)
+
 # ==============================================================================
 # 6. SISTEMA DE MONITOREO AUTOMÁTICO
 # ==============================================================================
@@ -976,10 +2930,11 @@ def handle_help_command(chat_id: str) -> None:
 Sistema principal de monitoreo automático:
 
 Componentes:
-1. check_all_farms_status: 
-   - Chequea todas las granjas registradas
-   - Ejecuta los procesadores de recursos
-   - Consolida y envía notificaciones
+1. FarmScheduler / run_due_farms:
+   - Despierta cada granja en su próximo deadline (cosecha, tala, minado,
+     colmena, Floating Island) en lugar de barrer todo cada 5 minutos
+   - Refresca desde la API solo cuando el snapshot caduca
+   - Ejecuta los procesadores de recursos y envía notificaciones consolidadas
 
 2. Manejo de estado:
    - Tracking de notificaciones enviadas
@@ -992,61 +2947,586 @@ Componentes:
    - Recuperación automática
 """
 
-def check_all_farms_status(user_data: Dict) -> None:
-    """Verifica el estado de todas las granjas registradas."""
-    farms_to_check = [(chat_id, info) for chat_id, info in user_data.items() 
-                      if not chat_id.startswith('_') and isinstance(info, dict) and info.get('farm_id')]
+def build_farm_notification(user_info: Dict, data: Dict, current_time_ms: float,
+                            fetched_at_ms: Optional[float] = None) -> Optional[str]:
+    """Ejecuta los procesadores de recursos sobre `data` y arma el aviso consolidado.
+
+    `fetched_at_ms` es cuándo se descargó `data` (por defecto, ahora).
+    Actualiza las banderas de `user_info`; debe llamarse con USER_STATE.lock.
+    Retorna None si no hay nada que avisar.
+    """
+    farm_id = user_info.get('farm_id')
+    notifications = []
     
-    if not farms_to_check:
-        logger.info("No hay granjas registradas para monitorear.")
-        return
+    # Procesar colmenas
+    with PhaseTimer("process_beehives"):
+        _, beehive_alerts = process_beehives(data, user_info, current_time_ms)
+    notifications.extend(beehive_alerts)
+    
+    # Procesar cultivos
+    with PhaseTimer("process_crops"):
+        crop_alerts = process_crops_alerts(data, user_info, current_time_ms, fetched_at_ms)
+    notifications.extend(crop_alerts)
+    
+    # Procesar árboles
+    with PhaseTimer("process_trees"):
+        tree_alerts = process_trees_alerts(data, user_info, current_time_ms, fetched_at_ms)
+    notifications.extend(tree_alerts)
+    
+    # Procesar piedras
+    with PhaseTimer("process_stones"):
+        stone_alerts = process_stones_alerts(data, user_info, current_time_ms, fetched_at_ms)
+    notifications.extend(stone_alerts)
+    
+    # Procesar Floating Island
+    with PhaseTimer("process_floating_island"):
+        floating_island_alerts = process_floating_island_alerts(data, user_info, current_time_ms)
+    notifications.extend(floating_island_alerts)
+    
+    # Aquí se pueden agregar más procesadores (animales, etc.)
+    
+    if not notifications:
+        return None
+    header = f"📢 *Eventos en Granja {farm_id}* 📢\n\n"
+    return header + "\n".join(notifications)
 
+def notify_farm_subscribers(farm_id: str, subscribers: List[Tuple[str, Dict]], data: Dict,
+                            user_data: Dict, snapshot_age_seconds: float = 0.0) -> None:
+    """Procesa un snapshot para cada chat suscrito y envía las notificaciones.
+
+    El procesamiento va bajo USER_STATE.lock y solo marca como modificados
+    los chats cuyas banderas cambiaron; los envíos a Telegram se hacen
+    después, sin bloquear a los comandos.
+    """
     current_time_ms = time.time() * 1000
-    
-    for idx, (chat_id, user_info) in enumerate(farms_to_check):
-        if idx > 0:
-            logger.info(f"⏸️ Pausa de 10s antes de chequear siguiente granja...")
-            time.sleep(10)
-        
-        farm_id = user_info.get('farm_id')
-        logger.info(f"🔍 Chequeando Farm ID {farm_id}...")
-        
-        data = fetch_farm_data(farm_id)
+    fetched_at_ms = current_time_ms - snapshot_age_seconds * 1000
+    outgoing = []
+    with USER_STATE.lock:
+        for chat_id, user_info in subscribers:
+            previous_status = dict(user_info.get('last_notified_status', {}))
+            message = build_farm_notification(user_info, data, current_time_ms, fetched_at_ms)
+            prune_notification_flags(user_info, data, current_time_ms)
+            changed_flags = diff_flags(previous_status, user_info.get('last_notified_status', {}))
+            if changed_flags:
+                USER_STATE.mark_dirty(chat_id, changed_flags)
+            if message:
+                outgoing.append((chat_id, message))
+
+    # Enviar notificaciones consolidadas
+    if outgoing:
+        METRICS.inc("sfl_alerts_sent_total", len(outgoing))
+    for chat_id, message in outgoing:
+        send_telegram_message(chat_id, message)
+        logger.info(f"✅ Notificación enviada a {chat_id} (Farm {farm_id})")
+
+def group_chats_by_farm(user_data: Dict) -> Dict[str, List[Tuple[str, Dict]]]:
+    """Agrupa los chats registrados por farm_id: {farm_id: [(chat_id, user_info), ...]}.
+
+    En modo clúster solo incluye las granjas que este proceso tiene asignadas.
+    """
+    farms: Dict[str, List[Tuple[str, Dict]]] = {}
+    for chat_id, info in user_data.items():
+        if chat_id.startswith('_') or not isinstance(info, dict) or not info.get('farm_id'):
+            continue
+        farm_id = str(info['farm_id'])
+        if FARM_SHARD.owns(farm_id):
+            farms.setdefault(farm_id, []).append((chat_id, info))
+    return farms
+
+class SweepProfiler:
+    """Captura bajo demanda los próximos N barridos del monitor.
+
+    - "cpu": cProfile. Hasta Python 3.11 solo ve el hilo que lo activa, así
+      que las descargas del pool se perfilan aparte (`wrap`) y al final todo
+      se une con pstats; desde 3.12 el perfil del barrido ya ve todos los
+      hilos y solo puede haber uno activo a la vez.
+    - "mem": tracemalloc durante los N barridos y una foto al terminar.
+
+    Se deja en PROFILE_DIR un archivo para analizar (.prof para pstats o
+    snakeviz, .snapshot para tracemalloc) y un resumen en .txt, y se avisa
+    al chat que la pidió. Sin captura en curso cuesta una lectura de
+    atributo por barrido.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.mode: Optional[str] = None
+        self.remaining = 0
+        self.requested_by: Optional[str] = None
+        self.last_report: Optional[str] = None
+        self._profiles: List[cProfile.Profile] = []
+        self._owns_tracemalloc = False
+        self._sweeps = 0
+
+    def request(self, mode: str, sweeps: int, requested_by: Optional[str] = None) -> bool:
+        """Programa una captura. Retorna False si ya hay una en curso."""
+        with self._lock:
+            if self.mode is not None:
+                return False
+            self.mode = mode
+            self.remaining = max(1, min(sweeps, PROFILE_MAX_SWEEPS))
+            self.requested_by = requested_by
+            self._profiles = []
+            self._sweeps = 0
+            if mode == "mem":
+                self._owns_tracemalloc = not tracemalloc.is_tracing()
+                if self._owns_tracemalloc:
+                    tracemalloc.start(10)
+        logger.warning(f"🔬 Captura {mode} de los próximos {self.remaining} barridos")
+        return True
+
+    def begin_sweep(self) -> Optional[cProfile.Profile]:
+        if self.mode != "cpu":
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as e:
+            # Otro perfilador ocupa el intérprete (p. ej. el bot corre bajo cProfile)
+            logger.error(f"🔬 No se pudo iniciar la captura de CPU: {e}")
+            with self._lock:
+                chat_id = self.requested_by
+                self.mode, self._profiles = None, []
+            if chat_id:
+                send_telegram_message(chat_id, f"❌ No se pudo iniciar la captura de CPU: {e}")
+            return None
+        return profile
+
+    def wrap(self, func: Callable) -> Callable:
+        """`func` envuelta en su propio cProfile si hay una captura de CPU en curso."""
+        if self.mode != "cpu" or sys.version_info >= (3, 12):
+            return func
+
+        def profiled(*args, **kwargs):
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Ya hay otro perfilador activo: la descarga se hace igual, sin perfil propio
+                return func(*args, **kwargs)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile.disable()
+                with self._lock:
+                    self._profiles.append(profile)
+        return profiled
+
+    def end_sweep(self, profile: Optional[cProfile.Profile], processed: int) -> None:
+        """Cierra el barrido; los vacíos (sin granjas vencidas) no cuentan.
+
+        Tampoco cuenta un barrido que ya había empezado cuando se pidió la
+        captura de CPU: no tiene perfil propio, solo el de algunas descargas.
+        """
+        if profile is not None:
+            profile.disable()
+        if self.mode is None:
+            return
+        with self._lock:
+            if self.mode == "cpu" and profile is None:
+                self._profiles = []
+                return
+            if not processed:
+                return
+            if profile is not None:
+                self._profiles.append(profile)
+            self._sweeps += 1
+            self.remaining -= 1
+            if self.remaining > 0:
+                return
+            mode, profiles, sweeps, chat_id = self.mode, self._profiles, self._sweeps, self.requested_by
+            snapshot = None
+            if mode == "mem":
+                snapshot = tracemalloc.take_snapshot()
+                if self._owns_tracemalloc:
+                    tracemalloc.stop()
+            self.mode, self._profiles = None, []
+
+        try:
+            path, summary = self._write_report(mode, profiles, snapshot)
+        except Exception as e:
+            logger.exception(f"🔬 No se pudo guardar el perfil: {e}")
+            if chat_id:
+                send_telegram_message(chat_id, f"❌ No se pudo guardar el perfil: {e}")
+            return
+        self.last_report = path
+        logger.warning(f"🔬 Perfil {mode} de {sweeps} barridos guardado en {path}")
+        if chat_id:
+            send_telegram_message(chat_id, f"🔬 *Perfil {mode}* de {sweeps} barridos\n`{path}`\n\n{summary}")
+
+    def _write_report(self, mode: str, profiles: List[cProfile.Profile],
+                      snapshot: Optional[tracemalloc.Snapshot]) -> Tuple[str, str]:
+        """Guarda la captura y su resumen. Retorna (ruta, top 8 para Telegram)."""
+        base = os.path.join(PROFILE_DIR, f"sfl_{'profile' if mode == 'cpu' else 'memory'}_{time.strftime('%Y%m%d-%H%M%S')}")
+        text = io.StringIO()
+        if mode == "cpu":
+            if not profiles:
+                raise ValueError("la captura no incluye ningún barrido")
+            stats = pstats.Stats(profiles[0], stream=text)
+            for profile in profiles[1:]:
+                stats.add(profile)
+            path = f"{base}.prof"
+            stats.dump_stats(path)
+            stats.sort_stats("tottime").print_stats(40)
+            top = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:8]
+            summary = "\n".join(f"• {tottime * 1000:.0f} ms `{func}`" if filename == "~" else
+                                f"• {tottime * 1000:.0f} ms `{func} ({os.path.basename(filename)}:{line})`"
+                                for (filename, line, func), (_, _, tottime, _, _) in top)
+        else:
+            snapshot = snapshot.filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+            path = f"{base}.snapshot"
+            snapshot.dump(path)
+            top = snapshot.statistics("lineno")
+            for stat in top[:40]:
+                text.write(f"{stat}\n")
+            summary = "\n".join(f"• {stat.size / 1024:.0f} KiB en `{os.path.basename(stat.traceback[0].filename)}:"
+                                f"{stat.traceback[0].lineno}` ({stat.count} bloques)" for stat in top[:8])
+        with open(f"{base}.txt", "w", encoding="utf-8") as f:
+            f.write(text.getvalue())
+        return path, summary
+
+    def status(self) -> str:
+        with self._lock:
+            if self.mode is not None:
+                return f"Captura {self.mode} en curso: faltan {self.remaining} barridos"
+        return f"Sin captura en curso. Último perfil: `{self.last_report}`" if self.last_report else "Sin captura en curso."
+
+SWEEP_PROFILER = SweepProfiler()
+
+def fetch_farms_concurrently(farm_ids: List[str]) -> Iterator[Tuple[str, Optional[Dict]]]:
+    """Descarga varias granjas en paralelo y genera (farm_id, data) según terminan.
+
+    El pool está acotado por FARM_FETCH_WORKERS; el ritmo real lo impone
+    `SFL_API_LIMITER`. `data` es None si la descarga falló.
+    """
+    if not farm_ids:
+        return
+    fetch = SWEEP_PROFILER.wrap(fetch_farm_data)
+    with ThreadPoolExecutor(max_workers=FARM_FETCH_WORKERS, thread_name_prefix="farm-fetch") as pool:
+        futures = {pool.submit(fetch, farm_id, True): farm_id for farm_id in farm_ids}
+        for future in as_completed(futures):
+            farm_id = futures[future]
+            try:
+                yield farm_id, future.result()
+            except Exception as e:
+                logger.error(f"Error inesperado chequeando Farm ID {farm_id}: {e}")
+                yield farm_id, None
+
+def compute_next_due_ms(data: Dict, current_time_ms: float) -> Optional[float]:
+    """Calcula el próximo instante (ms) en que alguna alerta de la granja vence.
+
+    Lee el mismo FarmTimerIndex que los procesadores: cultivos (plantedAt + base),
+    árboles (choppedAt + TREE_GROWTH_BASE_MS), piedras (minedAt +
+    STONE_RESPAWN_BASE_MS), fin de producción de colmenas (attachedUntil) y
+    las pre-alertas de Floating Island. Retorna None si no hay nada pendiente.
+    """
+    index = analyze_farm(data)
+    deadlines = [table.next_ready(current_time_ms) for table in (index.crops, index.trees, index.stones)]
+    deadlines.extend(hive.attached_until_ms for hive in index.beehives)
+    for start_time_ms, end_time_ms in index.island_events:
+        deadlines.append(start_time_ms - PRE_EVENT_ALERT_MS)
+        deadlines.append(end_time_ms - PRE_EVENT_ALERT_MS)
+
+    future = [d for d in deadlines if d is not None and d > current_time_ms]
+    return min(future) if future else None
+
+class FarmScheduler:
+    """Planificador de granjas por deadlines, basado en un heap de (instante, farm_id).
+
+    Cada granja tiene una sola entrada vigente; las reprogramaciones dejan
+    entradas viejas en el heap que se descartan al sacarlas (borrado perezoso).
+    También recuerda cada cuánto debe refrescarse cada granja desde la API.
+    """
+
+    def __init__(self):
+        self._heap: List[Tuple[float, str]] = []
+        self._due_at: Dict[str, float] = {}
+        self._refresh_interval: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def schedule(self, farm_id: str, due_at: float) -> None:
+        with self._lock:
+            self._due_at[farm_id] = due_at
+            heapq.heappush(self._heap, (due_at, farm_id))
+
+    def sync(self, farm_ids: Iterable[str]) -> None:
+        """Agrega granjas nuevas (vencen ya) y olvida las que nadie sigue."""
+        farm_ids = set(farm_ids)
+        now = time.time()
+        with self._lock:
+            for farm_id in farm_ids - self._due_at.keys():
+                self._due_at[farm_id] = now
+                heapq.heappush(self._heap, (now, farm_id))
+            for farm_id in self._due_at.keys() - farm_ids:
+                del self._due_at[farm_id]
+                self._refresh_interval.pop(farm_id, None)
+
+    def pop_due(self, now: float) -> List[str]:
+        """Saca del heap todas las granjas cuyo deadline ya pasó."""
+        due = []
+        lags = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                due_at, farm_id = heapq.heappop(self._heap)
+                if self._due_at.get(farm_id) == due_at:
+                    del self._due_at[farm_id]
+                    due.append(farm_id)
+                    lags.append(now - due_at)
+        for lag in lags:
+            METRICS.observe("sfl_farm_due_lag_seconds", lag)
+        return due
+
+    def _next_due_at(self) -> Optional[float]:
+        """Deadline vigente más próximo (descarta las entradas viejas del tope). Llamar con el lock."""
+        while self._heap and self._due_at.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def seconds_until_next(self, now: float) -> Optional[float]:
+        with self._lock:
+            due_at = self._next_due_at()
+            return None if due_at is None else max(0.0, due_at - now)
+
+    def overdue_seconds(self, now: float) -> float:
+        """Cuánto lleva vencida la granja más atrasada sin procesar (0 si ninguna)."""
+        with self._lock:
+            due_at = self._next_due_at()
+            return 0.0 if due_at is None else max(0.0, now - due_at)
+
+    def refresh_interval(self, farm_id: str) -> float:
+        with self._lock:
+            return self._refresh_interval.get(farm_id, FARM_CHECK_INTERVAL_SECONDS)
+
+    def set_refresh_interval(self, farm_id: str, seconds: float) -> None:
+        with self._lock:
+            self._refresh_interval[farm_id] = seconds
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._due_at)
+
+FARM_SCHEDULER = FarmScheduler()
+
+def reschedule_farm(farm_id: str, data: Dict, snapshot_age_seconds: float) -> None:
+    """Programa la próxima visita a la granja según su snapshot.
+
+    La granja se despierta en el próximo deadline de alerta (que se procesa
+    con el snapshot en caché, sin llamar a la API) o cuando toca refrescarla:
+    cada FARM_CHECK_INTERVAL_SECONDS si tiene temporizadores pendientes, o
+    cada FARM_IDLE_REFRESH_SECONDS si no tiene nada pendiente.
+    """
+    now = time.time()
+    next_due_ms = compute_next_due_ms(data, now * 1000)
+    interval = FARM_CHECK_INTERVAL_SECONDS if next_due_ms is not None else FARM_IDLE_REFRESH_SECONDS
+    FARM_SCHEDULER.set_refresh_interval(farm_id, interval)
+
+    next_refresh_at = now - snapshot_age_seconds + interval
+    if next_due_ms is not None:
+        next_refresh_at = min(next_refresh_at, next_due_ms / 1000 + SCHEDULER_SLACK_SECONDS)
+    FARM_SCHEDULER.schedule(farm_id, next_refresh_at)
+
+def run_due_farms(user_data: Dict) -> int:
+    """Procesa las granjas cuyo deadline venció en `FARM_SCHEDULER`.
+
+    Las que todavía tienen un snapshot dentro de su intervalo de refresco se
+    procesan desde la caché; el resto se descarga en paralelo. Retorna
+    cuántas granjas vencidas había.
+    """
+    sweep_start = time.perf_counter()
+    due_ids = FARM_SCHEDULER.pop_due(time.time())
+    if not due_ids:
+        return 0
+
+    with USER_STATE.lock:
+        farms = group_chats_by_farm(user_data)
+    snapshots = []
+    to_fetch = []
+    for farm_id in due_ids:
+        if farm_id not in farms:
+            continue
+        cached = FARM_CACHE.lookup(farm_id)
+        if cached is not None and cached[1] < FARM_SCHEDULER.refresh_interval(farm_id):
+            snapshots.append((farm_id, cached[0], cached[1]))
+        else:
+            to_fetch.append(farm_id)
+
+    fetched = ((farm_id, data, 0.0) for farm_id, data in fetch_farms_concurrently(to_fetch))
+    for farm_id, data, age_seconds in itertools.chain(snapshots, fetched):
+        BOT_HEALTH.monitor_beat = time.time()
         if not data:
+            retry_at = max(time.time() + FARM_CHECK_INTERVAL_SECONDS, FARM_BREAKER.open_until(farm_id))
+            FARM_SCHEDULER.schedule(farm_id, retry_at)
             continue
+
+        notify_farm_subscribers(farm_id, farms[farm_id], data, user_data, age_seconds)
+        with PhaseTimer("schedule"):
+            reschedule_farm(farm_id, data, age_seconds)
+
+    METRICS.observe("sfl_sweep_duration_seconds", time.perf_counter() - sweep_start)
+    logger.info(f"⏰ {len(due_ids)} granjas procesadas ({len(to_fetch)} descargadas); próximas en "
+                f"{FARM_SCHEDULER.seconds_until_next(time.time()) or 0:.0f}s")
+    return len(due_ids)
+
+def run_farm_monitor(user_data: Dict, stop_event: threading.Event) -> None:
+    """Hilo del monitor: procesa las granjas vencidas y duerme hasta el próximo deadline."""
+    while not stop_event.is_set():
+        until_next_due = None
+        try:
+            with USER_STATE.lock:
+                farm_ids = list(group_chats_by_farm(user_data).keys())
+            FARM_SCHEDULER.sync(farm_ids)
+            profile = SWEEP_PROFILER.begin_sweep()
+            processed = 0
+            try:
+                processed = run_due_farms(user_data)
+            finally:
+                SWEEP_PROFILER.end_sweep(profile, processed)
+            BOT_HEALTH.monitor_beat = time.time()
+            until_next_due = FARM_SCHEDULER.seconds_until_next(time.time())
+        except Exception as e:
+            logger.exception(f"🚨 ERROR CRÍTICO en el monitor de granjas: {e}")
         
-        notifications = []
-        
-        # Procesar colmenas
-        _, beehive_alerts = process_beehives(data, user_info, current_time_ms)
-        notifications.extend(beehive_alerts)
-        
-        # Procesar cultivos
-        crop_alerts = process_crops_alerts(data, user_info, current_time_ms)
-        notifications.extend(crop_alerts)
-        
-        # Procesar árboles
-        tree_alerts = process_trees_alerts(data, user_info, current_time_ms)
-        notifications.extend(tree_alerts)
-        
-        # Procesar piedras
-        stone_alerts = process_stones_alerts(data, user_info, current_time_ms)
-        notifications.extend(stone_alerts)
-        
-        # Procesar Floating Island
-        floating_island_alerts = process_floating_island_alerts(data, user_info, current_time_ms)
-        notifications.extend(floating_island_alerts)
-        
-        # Aquí se pueden agregar más procesadores (animales, etc.)
-        
-        # Enviar notificaciones consolidadas
-        if notifications:
-            header = f"📢 *Eventos en Granja {farm_id}* 📢\n\n"
-            full_message = header + "\n".join(notifications)
-            send_telegram_message(chat_id, full_message)
-            logger.info(f"✅ Notificación enviada a {chat_id} (Farm {farm_id})")
-        
-        save_user_data(user_data)
+        # Despertar como máximo cada LOOP_SLEEP_SECONDS para ver granjas nuevas
+        if until_next_due is None:
+            until_next_due = LOOP_SLEEP_SECONDS
+        stop_event.wait(min(LOOP_SLEEP_SECONDS, until_next_due))
+
+def hash_point(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+class HashRing:
+    """Anillo de hash consistente: cada farm_id pertenece al primer worker que le sigue.
+
+    Con CLUSTER_VIRTUAL_NODES puntos por worker el reparto es parejo, y al
+    entrar o salir un worker solo cambian de dueño ~1/N de las granjas.
+    """
+
+    def __init__(self, nodes: Iterable[str], virtual_nodes: int = CLUSTER_VIRTUAL_NODES):
+        self.nodes = sorted(set(nodes))
+        points = sorted((hash_point(f"{node}#{i}"), node) for node in self.nodes for i in range(virtual_nodes))
+        self._points = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def owner(self, key: str) -> Optional[str]:
+        if not self._points:
+            return None
+        i = bisect.bisect(self._points, hash_point(key)) % len(self._points)
+        return self._owners[i]
+
+class FarmShard:
+    """Qué granjas monitorea este proceso.
+
+    Fuera del modo clúster (`ring` None) se queda con todas; un worker solo
+    con las que el anillo le asigna.
+    """
+
+    def __init__(self):
+        self.member_id = CLUSTER_MEMBER_ID
+        self.ring: Optional[HashRing] = None
+
+    def owns(self, farm_id: str) -> bool:
+        ring = self.ring
+        return ring is None or ring.owner(farm_id) == self.member_id
+
+FARM_SHARD = FarmShard()
+
+class ClusterMembership:
+    """Registro de procesos vivos del clúster en la base SQLite compartida.
+
+    Cada proceso escribe su latido en `cluster_members`; los que no laten en
+    CLUSTER_MEMBER_TTL_SECONDS se consideran caídos y sus granjas se
+    reparten entre el resto.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS cluster_members (
+            member_id TEXT PRIMARY KEY,
+            role TEXT NOT NULL,
+            heartbeat_at REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path: str, member_id: str, role: str):
+        self.member_id = member_id
+        self.role = role
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(self.SCHEMA)
+        self._conn.commit()
+
+    def heartbeat(self) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO cluster_members (member_id, role, heartbeat_at) VALUES (?, ?, ?)",
+                               (self.member_id, self.role, time.time()))
+
+    def alive_members(self) -> Dict[str, str]:
+        """{member_id: role} de los procesos con latido reciente."""
+        with self._lock:
+            rows = self._conn.execute("SELECT member_id, role FROM cluster_members WHERE heartbeat_at >= ?",
+                                      (time.time() - CLUSTER_MEMBER_TTL_SECONDS,))
+            return dict(rows.fetchall())
+
+    def leave(self) -> None:
+        with self._lock:
+            with self._conn:
+                self._conn.execute("DELETE FROM cluster_members WHERE member_id = ?", (self.member_id,))
+            self._conn.close()
+
+CLUSTER_VIEW: Optional[Tuple[Tuple[str, ...], int]] = None  # (workers, procesos) aplicados
+
+def apply_cluster_membership(members: Dict[str, str]) -> bool:
+    """Reconstruye el anillo de workers y reparte las cuotas entre los procesos vivos.
+
+    Retorna True si cambió la membresía (rebalanceo).
+    """
+    global CLUSTER_VIEW
+    workers = tuple(sorted(member for member, role in members.items() if role == "worker"))
+    processes = max(1, len(members))
+    if CLUSTER_VIEW == (workers, processes):
+        return False
+    CLUSTER_VIEW = (workers, processes)
+    SFL_API_LIMITER.set_base_rate(SFL_API_REQUESTS_PER_MINUTE / 60.0 / processes)
+    TELEGRAM_OUTBOX.set_rate(TELEGRAM_MESSAGES_PER_SECOND / processes)
+    if CLUSTER_ROLE == "worker":
+        FARM_SHARD.ring = HashRing(workers or [FARM_SHARD.member_id])
+    logger.warning(f"🧩 Clúster: {len(workers)} workers, {processes} procesos; "
+                   f"cuota por proceso {SFL_API_REQUESTS_PER_MINUTE / processes:.1f}/min")
+    return True
+
+def run_cluster_heartbeat(membership: ClusterMembership, stop_event: threading.Event) -> None:
+    """Hilo de latido: mantiene la membresía, rebalancea y relee el estado compartido."""
+    last_refresh = time.time()
+    while not stop_event.wait(CLUSTER_HEARTBEAT_SECONDS):
+        try:
+            membership.heartbeat()
+            rebalanced = apply_cluster_membership(membership.alive_members())
+            if rebalanced or time.time() - last_refresh >= CLUSTER_STATE_REFRESH_SECONDS:
+                # Al rebalancear, las banderas propias se escriben antes de que
+                # otro worker tome esas granjas, y se leen las del resto
+                USER_STATE.refresh()
+                last_refresh = time.time()
+        except Exception as e:
+            logger.exception(f"🚨 Error en el latido del clúster: {e}")
+
+def print_cluster_status() -> None:
+    """Muestra los procesos vivos y cuántas granjas registradas le tocan a cada worker."""
+    membership = ClusterMembership(STATE_DB_FILE, "cluster-status", "observer")
+    members = membership.alive_members()
+    ring = HashRing(member for member, role in members.items() if role == "worker")
+    backend = SqliteBackend(STATE_DB_FILE)
+    farm_ids = {str(info['farm_id']) for key, info in backend.load_all().items()
+                if not key.startswith('_') and isinstance(info, dict) and info.get('farm_id')}
+    backend.close()
+    membership.leave()
+    counts: Dict[str, int] = {}
+    for farm_id in farm_ids:
+        owner = ring.owner(farm_id) or "(sin worker)"
+        counts[owner] = counts.get(owner, 0) + 1
+    for member, role in sorted(members.items()):
+        print(f"{member:<30} {role:<12} {counts.get(member, 0) if role == 'worker' else '-':>6} granjas")
+    if "(sin worker)" in counts:
+        print(f"{'(sin worker)':<30} {'':<12} {counts['(sin worker)']:>6} granjas")
 
 # ==============================================================================
 # 7. BUCLE PRINCIPAL Y EJECUCIÓN
@@ -1059,10 +3539,13 @@ Componentes:
    - Carga de configuración
    - Verificación de tokens
    - Preparación de logging
+   - Lease de instancia única (las copias extra esperan en standby)
 
-2. Bucle principal:
-   - Manejo de comandos (rápido)
-   - Chequeo de granjas (periódico)
+2. Componentes concurrentes (hilos conectados por colas):
+   - Recepción de updates de Telegram (long-polling)
+   - Workers de comandos (una cola por worker, orden por chat)
+   - Monitor de granjas (por deadlines, ver FarmScheduler)
+   - Servidor HTTP: webhook, /metrics y /healthz, /readyz
    - Control de errores y recuperación
 
 3. Mantenimiento:
@@ -1072,33 +3555,222 @@ Componentes:
 """
 
 def initialize_bot() -> None:
-    """Inicializa el bot obteniendo el último update_id."""
+    """Inicializa el offset de updates de Telegram.
+
+    Si el estado tiene un `_last_update_id` guardado se reanuda desde ahí, y
+    los comandos enviados mientras el bot estaba caído se procesan al
+    arrancar. Sin checkpoint (primer arranque) se salta al último update_id.
+    """
     global LAST_UPDATE_ID
     
-    telegram_url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/getUpdates"
+    with USER_STATE.lock:
+        checkpoint = USER_STATE.data.get('_last_update_id')
+    if isinstance(checkpoint, int):
+        LAST_UPDATE_ID = checkpoint
+        logger.info(f"🔄 Reanudando desde update_id guardado: {LAST_UPDATE_ID}")
+        return
+    
+    telegram_url = telegram_api_url("getUpdates")
     try:
-        response = requests.get(telegram_url, params={'timeout': 1}, timeout=5)
+        response = TELEGRAM_SESSION.get(
+            telegram_url, params={'timeout': 1},
+            timeout=(HTTP_CONNECT_TIMEOUT_SECONDS, 5),
+        )
         updates = response.json().get('result', [])
         if updates:
             LAST_UPDATE_ID = updates[-1]['update_id']
             logger.info(f"🔄 Inicializado con update_id: {LAST_UPDATE_ID}")
+            checkpoint_update_offset()
     except requests.exceptions.RequestException as e:
         logger.warning(f"No se pudo inicializar update_id: {e}")
 
+class InstanceLease:
+    """Lease con vencimiento en SQLite para que una sola instancia atienda el bot.
+
+    Quien tiene el lease lo renueva cada INSTANCE_LEASE_RENEW_SECONDS; si deja
+    de hacerlo durante INSTANCE_LEASE_TTL_SECONDS (proceso colgado o muerto),
+    otra instancia puede tomarlo. Al apagar limpiamente se libera enseguida.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS instance_leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path: str, holder: str, name: str = "telegram-intake",
+                 ttl: float = INSTANCE_LEASE_TTL_SECONDS):
+        self.holder = holder
+        self.name = name
+        self.ttl = ttl
+        self.expires_at = 0.0   # Vencimiento del lease propio (según el último acquire)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(self.SCHEMA)
+
+    def acquire(self) -> bool:
+        """Toma o renueva el lease. Retorna False si lo tiene otra instancia vigente."""
+        with self._lock:
+            now = time.time()
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT holder, expires_at FROM instance_leases WHERE name = ?",
+                                         (self.name,)).fetchone()
+                if row is not None and row[0] != self.holder and row[1] > now:
+                    self._conn.execute("ROLLBACK")
+                    return False
+                self._conn.execute("INSERT OR REPLACE INTO instance_leases (name, holder, expires_at) VALUES (?, ?, ?)",
+                                   (self.name, self.holder, now + self.ttl))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self.expires_at = now + self.ttl
+            return True
+
+    def current_holder(self) -> Optional[str]:
+        """Instancia con el lease vigente (None si está libre o no se pudo leer)."""
+        with self._lock:
+            try:
+                row = self._conn.execute("SELECT holder FROM instance_leases WHERE name = ? AND expires_at > ?",
+                                         (self.name, time.time())).fetchone()
+            except sqlite3.Error:
+                return None
+            return row[0] if row else None
+
+    def release(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM instance_leases WHERE name = ? AND holder = ?", (self.name, self.holder))
+            self._conn.close()
+
+def wait_for_instance_lease(lease: InstanceLease, stop_event: threading.Event) -> bool:
+    """Espera en standby hasta obtener el lease. Retorna False si se pidió parar antes."""
+    announced = False
+    while not stop_event.is_set():
+        try:
+            if lease.acquire():
+                if announced:
+                    logger.warning(f"🔑 Lease obtenido por {lease.holder}; esta instancia pasa a activa")
+                return True
+            if not announced:
+                logger.warning(f"⏸️ En standby: la instancia {lease.current_holder()} tiene el lease")
+                BOT_HEALTH.phase = "standby"
+                announced = True
+        except sqlite3.Error as e:
+            logger.error(f"🔑 Error consultando el lease: {e}")
+        stop_event.wait(INSTANCE_LEASE_RENEW_SECONDS)
+    return False
+
+def run_instance_lease(lease: InstanceLease, stop_event: threading.Event) -> None:
+    """Hilo de renovación del lease.
+
+    Si otra instancia lo tomó (o no se pudo renovar antes de que venciera),
+    esta deja de escribir el estado y se detiene sin procesar nada más.
+    """
+    while not stop_event.wait(INSTANCE_LEASE_RENEW_SECONDS):
+        try:
+            if lease.acquire():
+                continue
+        except sqlite3.Error as e:
+            logger.error(f"🔑 Error renovando el lease: {e}")
+            if time.time() < lease.expires_at:
+                continue
+        USER_STATE.fence()
+        logger.error(f"🔑 Lease perdido: otra instancia ({lease.current_holder()}) atiende el bot; deteniendo")
+        stop_event.set()
+        return
+
 def main_loop() -> None:
-    """Bucle principal del bot."""
-    initialize_bot()
-    
-    last_farm_check_time = time.time() - FARM_CHECK_INTERVAL_SECONDS
-    
-    initial_user_data = load_user_data()
-    loaded_farms = [info.get('farm_id') for info in initial_user_data.values() 
+    """Bucle principal del bot.
+
+    Arranca tres componentes concurrentes conectados por colas: la recepción
+    de updates (long-polling o webhook, según TELEGRAM_INTAKE_MODE),
+    COMMAND_WORKERS workers de comandos y el monitor de granjas. Un barrido lento nunca retrasa la respuesta a un
+    comando, y un comando lento solo bloquea su propia cola.
+
+    En modo clúster (CLUSTER_ROLE) el `coordinator` solo recibe y atiende
+    comandos, y cada `worker` solo monitorea su parte de las granjas; todos
+    comparten el estado en SQLite y se reparten la cuota de las APIs.
+
+    Quien recibe updates necesita el lease de instancia única: una segunda
+    copia (p. ej. durante un deploy) espera en standby sin leer getUpdates
+    ni escribir el estado, y toma el relevo en cuanto la primera se apaga o
+    deja de renovarlo.
+    """
+    cluster_mode = CLUSTER_ROLE in ("coordinator", "worker")
+    runs_intake = CLUSTER_ROLE != "worker"
+    runs_monitor = CLUSTER_ROLE != "coordinator"
+    webhook_mode = TELEGRAM_INTAKE_MODE == "webhook"
+    stop_event = threading.Event()
+
+    # SIGTERM (p. ej. reinicio del dyno) apaga igual que Ctrl+C
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+        # kill -USR1 / -USR2 <pid>: perfil de CPU / memoria de los próximos barridos
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: SWEEP_PROFILER.request("cpu", PROFILE_DEFAULT_SWEEPS))
+            signal.signal(signal.SIGUSR2, lambda signum, frame: SWEEP_PROFILER.request("mem", PROFILE_DEFAULT_SWEEPS))
+
+    if webhook_mode and runs_intake and not WEBHOOK_SECRET_TOKEN:
+        logger.error("🔒 El modo webhook necesita WEBHOOK_SECRET_TOKEN: sin él cualquiera puede enviar comandos falsos")
+        return
+
+    # El puerto se abre ya en standby: /healthz responde mientras se espera el lease.
+    # PORT es de quien recibe updates (el webhook llega ahí); los workers nunca lo ocupan
+    http_server = None
+    if runs_intake and (METRICS_ENABLED or webhook_mode):
+        http_server = start_http_server(WEBHOOK_PORT)
+        if webhook_mode and http_server is None:
+            return
+    elif not runs_intake and METRICS_ENABLED:
+        http_server = start_http_server(METRICS_PORT, allow_any_port=True)
+    BOT_HEALTH.runs_monitor = runs_monitor
+
+    lease = None
+    if runs_intake and INSTANCE_LEASE_ENABLED:
+        lease = InstanceLease(INSTANCE_LEASE_FILE, INSTANCE_HOLDER_ID)
+        try:
+            acquired = wait_for_instance_lease(lease, stop_event)
+        except KeyboardInterrupt:
+            acquired = False
+        if not acquired:
+            lease.release()
+            stop_http_server(http_server)
+            return
+
+    if cluster_mode and STATE_BACKEND != "sqlite":
+        logger.warning(f"🧩 El modo clúster comparte el estado en {STATE_DB_FILE} (backend sqlite)")
+    # El estado se lee con el lease ya tomado: incluye lo último que guardó la instancia anterior
+    user_data = USER_STATE.load(create_state_backend("sqlite" if cluster_mode else STATE_BACKEND))
+    if runs_intake and not webhook_mode:
+        initialize_bot()
+
+    membership = None
+    if cluster_mode:
+        membership = ClusterMembership(STATE_DB_FILE, CLUSTER_MEMBER_ID, CLUSTER_ROLE)
+        membership.heartbeat()
+        apply_cluster_membership(membership.alive_members())
+        if CLUSTER_ROLE == "worker":
+            # Dar tiempo a los demás workers a ver el rebalanceo y guardar sus banderas
+            stop_event.wait(2 * CLUSTER_HEARTBEAT_SECONDS)
+            membership.heartbeat()
+            apply_cluster_membership(membership.alive_members())
+            USER_STATE.refresh()
+    loaded_farms = [info.get('farm_id') for info in user_data.values() 
                     if isinstance(info, dict) and info.get('farm_id')]
     
     logger.info("=" * 50)
     logger.info("🤖 Bot de Sunflower Land Multi-Usuario Iniciado")
-    logger.info(f"⏱️ Intervalo de comandos: {LOOP_SLEEP_SECONDS}s")
-    logger.info(f"⏱️ Intervalo de granja: {FARM_CHECK_INTERVAL_SECONDS}s")
+    logger.info(f"🧩 Rol: {CLUSTER_ROLE} ({CLUSTER_MEMBER_ID})" if cluster_mode else "🧩 Rol: proceso único")
+    if lease is not None:
+        logger.info(f"🔑 Lease de instancia: {lease.holder} (TTL {INSTANCE_LEASE_TTL_SECONDS:.0f}s)")
+    logger.info(f"📥 Recepción de comandos: {'webhook' if webhook_mode else 'long-polling'}")
+    logger.info(f"⏱️ Workers de comandos: {COMMAND_WORKERS}")
+    logger.info(f"💾 Backend de estado: {USER_STATE.backend.name}")
+    logger.info(f"⏱️ Refresco de granja: {FARM_CHECK_INTERVAL_SECONDS}s (inactivas: {FARM_IDLE_REFRESH_SECONDS}s)")
     
     if loaded_farms:
         logger.info(f"✅ Granjas cargadas: {', '.join(loaded_farms)}")
@@ -1107,25 +3779,68 @@ def main_loop() -> None:
     
     logger.info("=" * 50)
 
-    while True:
-        try:
-            user_data = load_user_data()
-            user_data = handle_telegram_commands(user_data)
-            
-            current_time = time.time()
-            if current_time - last_farm_check_time >= FARM_CHECK_INTERVAL_SECONDS:
-                logger.info("🔔 Iniciando chequeo programado de granjas...")
-                check_all_farms_status(user_data)
-                last_farm_check_time = current_time
-            
-        except Exception as e:
-            logger.exception(f"🚨 ERROR CRÍTICO en el bucle principal: {e}")
-        
-        time.sleep(LOOP_SLEEP_SECONDS)
+    threads = []
+    command_workers = []
+    if runs_intake:
+        command_queues = [queue.Queue(maxsize=COMMAND_QUEUE_MAXSIZE) for _ in range(max(1, COMMAND_WORKERS))]
+        threads.append(threading.Thread(target=run_webhook_server if webhook_mode else run_update_intake,
+                                        args=(command_queues, stop_event), name="telegram-intake"))
+        command_workers = [
+            threading.Thread(target=run_command_worker, args=(command_queue, user_data, stop_event), name=f"command-worker-{i}")
+            for i, command_queue in enumerate(command_queues)
+        ]
+        threads += command_workers
+        COMMAND_QUEUES[:] = command_queues
+    if runs_monitor:
+        threads.append(threading.Thread(target=run_farm_monitor, args=(user_data, stop_event), name="farm-monitor"))
+    if membership is not None:
+        threads.append(threading.Thread(target=run_cluster_heartbeat, args=(membership, stop_event), name="cluster-heartbeat"))
+    if lease is not None:
+        threads.append(threading.Thread(target=run_instance_lease, args=(lease, stop_event), name="instance-lease"))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    BOT_HEALTH.phase = "active"
+
+    try:
+        # El hilo principal se encarga de persistir el estado en lotes
+        while not stop_event.wait(1):
+            USER_STATE.flush_if_due()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logger.warning("🛑 Deteniendo el bot...")
+        BOT_HEALTH.phase = "stopping"
+        COMMAND_QUEUES[:] = []   # El webhook responde 503 y Telegram reintenta con la próxima instancia
+        stop_event.set()
+        deadline = time.time() + 10
+        for thread in command_workers:
+            thread.join(timeout=max(0.0, deadline - time.time()))
+        if not TELEGRAM_OUTBOX.drain(timeout=10):
+            logger.warning(f"📤 {TELEGRAM_OUTBOX.pending_count()} mensajes sin enviar al apagar")
+        USER_STATE.flush()
+        USER_STATE.backend.close()
+        if membership is not None:
+            membership.leave()
+        if lease is not None:
+            # Liberar al final: el standby lee el estado ya guardado
+            lease.release()
+        stop_http_server(http_server)
 
 # ==============================================================================
 # 8. INICIO DEL SCRIPT
 # ==============================================================================
 
 if __name__ == "__main__":
-    main_loop()
\ No newline at end of file
+    if len(sys.argv) >= 4 and sys.argv[1] == "webhook-send":
+        # Cliente de prueba: python sfl_bot_multi_4_advcrops-c.py webhook-send CHAT_ID "/crops"
+        base_url = os.getenv("WEBHOOK_TEST_URL", f"http://127.0.0.1:{WEBHOOK_PORT}")
+        print(WebhookTestClient(base_url).send_text(sys.argv[3], chat_id=int(sys.argv[2])))
+    elif len(sys.argv) >= 2 and sys.argv[1] in ("coordinator", "worker"):
+        # Modo clúster: un coordinator y N workers con el mismo STATE_DB_FILE
+        CLUSTER_ROLE = sys.argv[1]
+        main_loop()
+    elif len(sys.argv) >= 2 and sys.argv[1] == "cluster-status":
+        print_cluster_status()
+    else:
+        main_loop()
\ No newline at end of file